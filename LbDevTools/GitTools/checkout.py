@@ -14,9 +14,9 @@ from __future__ import print_function
 __author__ = "Marco Clemencic <marco.clemencic@cern.ch>"
 
 import os
-import git
 import logging
 from argparse import ArgumentParser
+from collections import OrderedDict
 from difflib import get_close_matches
 from LbDevTools.GitTools.common import (
     add_verbosity_argument,
@@ -24,23 +24,120 @@ from LbDevTools.GitTools.common import (
     add_version_argument,
 )
 
+# maximum number of lists of packages recorded in the git directory
+PACKAGES_INDEX_SIZE = 64
 
-def _checkout(repo, commit, remote, path, configfile):
-    logging.debug("checking out %s", path)
-    repo.git.checkout(commit, "--", path)
 
+def _checkout(repo, checkouts, configfile):
+    """
+    Check out the paths from the commits in 'checkouts', a list of
+    (commit, remote, paths), and record them in 'configfile'.
+    """
+    import git
+
+    for commit, remote, paths in checkouts:
+        logging.debug("checking out %s from %s", ", ".join(paths), commit)
+        fetch_missing_blobs(repo, commit, remote, paths)
+        repo.git.checkout(commit, "--", *paths)
+
+    base = repo.commit("HEAD").hexsha
     with git.GitConfigParser(configfile, read_only=False) as conf:
-        section = 'lb-checkout "{}.{}"'.format(remote, path)
-        if not conf.has_section(section):
-            conf.add_section(section)
-        conf.set(section, "base", repo.commit("HEAD").hexsha)
-        conf.set(section, "imported", repo.commit(commit).hexsha)
+        for commit, remote, paths in checkouts:
+            imported = repo.commit(commit).hexsha
+            for path in paths:
+                section = 'lb-checkout "{}.{}"'.format(remote, path)
+                if not conf.has_section(section):
+                    conf.add_section(section)
+                conf.set(section, "base", base)
+                conf.set(section, "imported", imported)
+
+
+def fetch_missing_blobs(repo, commit, remote, paths):
+    """
+    If 'remote' is a partial clone remote (see `git lb-use --filter`), fetch
+    in one go the files in 'paths' that are not yet available locally (git
+    would fetch them one by one during the checkout).
+    """
+    from subprocess import Popen, PIPE, CalledProcessError
+
+    with repo.config_reader() as conf:
+        section = 'remote "{}"'.format(remote)
+        if not conf.get_value(section, "promisor", False):
+            return
+        spec = conf.get_value(section, "partialclonefilter", "blob:none")
+
+    # only the objects of the requested paths are listed
+    wanted = sorted(
+        set(
+            l[1:]
+            for l in repo.git.rev_list(
+                "--objects", "--no-walk", "--missing=print", commit, "--", *paths
+            ).splitlines()
+            if l.startswith("?")
+        )
+    )
+    if not wanted:
+        return
+
+    logging.debug("fetching %d files from %s", len(wanted), remote)
+    # this is the command git uses to fetch missing objects
+    cmd = [
+        "git",
+        "-c",
+        "fetch.negotiationAlgorithm=noop",
+        "fetch",
+        remote,
+        "--no-tags",
+        "--recurse-submodules=no",
+        "--filter={}".format(spec),
+        "--stdin",
+    ]
+    if repo.git.version_info >= (2, 29):
+        # do not overwrite FETCH_HEAD (the option is not known to older git)
+        cmd.append("--no-write-fetch-head")
+    proc = Popen(cmd, cwd=repo.working_dir, stdin=PIPE)
+    proc.communicate("".join(oid + "\n" for oid in wanted).encode())
+    if proc.returncode:
+        raise CalledProcessError(proc.returncode, cmd)
+
+
+def read_manifest(filename):
+    """
+    Read a list of packages to check out from a file.
+
+    Each line of the file contains a commit and a path (separated by
+    spaces), empty lines and lines starting with '#' are ignored.
+
+    Args:
+        filename (String): The name of the file to read
+
+    Returns:
+        a list of (commit, path)
+    """
+    entries = []
+    with open(filename) as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            fields = line.split()
+            if len(fields) != 2:
+                raise ValueError(
+                    "{}:{}: invalid line, expected "
+                    "'<commit> <path>'".format(filename, lineno)
+                )
+            entries.append(tuple(fields))
+    return entries
 
 
 def get_packages_of(repo, commit):
     """
     Get packages of repo at certain commit. Packages contain either a CmakeLists.txt or a requirements file
 
+    The list of packages of a tree is recorded in the git directory, so that
+    it is computed only once (only the PACKAGES_INDEX_SIZE most recently used
+    lists are kept).
+
     Args:
         repo (Repo): The repository in which we are searching for packages
         commit (String): The commit in which we are searching for packages
@@ -48,35 +145,212 @@ def get_packages_of(repo, commit):
     Returns:
         a set of strings representing packages
     """
-    cmakelist_packages = get_packages_that_contain("/CMakeLists.txt", repo, commit)
-    requirements_packages = get_packages_that_contain("/requirements", repo, commit)
-    # Packages that contain CMakeLists.txt files, have them at the top directory of the package
-    # while requirements files are inside a cmt folder, therefore we need to go one level higher
-    # so, we remove the '/cmt' from the end of the path
-    requirements_packages = set(
-        path.rsplit("/", 1)[0] for path in requirements_packages
-    )
+    tree = repo.git.rev_parse(commit + "^{tree}")
+    index_dir = os.path.join(repo.git_dir, "lb-checkout-packages")
+    index = os.path.join(index_dir, tree)
+    try:
+        with open(index) as f:
+            pkgs = set(f.read().splitlines())
+        try:
+            os.utime(index, None)  # mark as recently used
+        except OSError:
+            pass
+        return pkgs
+    except IOError:
+        pass
+
+    pkgs = find_packages(repo, tree)
+
+    from LbDevTools.SourceTools import write_file_atomically
+
+    try:
+        write_file_atomically(index, "".join(p + "\n" for p in sorted(pkgs)))
+        prune_packages_index(index_dir)
+    except (IOError, OSError) as err:
+        logging.debug("cannot record the packages of %s: %s", tree, err)
+    return pkgs
 
-    return cmakelist_packages.union(requirements_packages)
 
+def prune_packages_index(index_dir, size=PACKAGES_INDEX_SIZE):
+    """
+    Remove from 'index_dir' all but the 'size' most recently used lists of
+    packages.
+    """
+    entries = []
+    for name in os.listdir(index_dir):
+        path = os.path.join(index_dir, name)
+        try:
+            entries.append((os.stat(path).st_mtime, path))
+        except OSError:
+            pass  # removed by a concurrent process
+    entries.sort(reverse=True)
+    for _, path in entries[size:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
 
-def get_packages_that_contain(file_name, repo, commit):
+
+def find_packages(repo, tree):
     """
-    Get packages of repo at certain commit that contain a certain file
+    Get packages of repo in a tree, listing its files with a single git
+    command.
 
     Args:
-        file_name (String): The name of the file we are searching for
         repo (Repo): The repository in which we are searching for packages
-        commit (String): The commit in which we are searching for packages
+        tree (String): The tree in which we are searching for packages
 
     Returns:
         a set of strings representing packages
     """
-    return set(
-        os.path.dirname(b.path)
-        for b in repo.commit(commit).tree.traverse()
-        if b.path.endswith(file_name)
+    from LbDevTools.SourceTools import iter_output
+
+    pkgs = set()
+    for path in iter_output(
+        ["git", "-C", repo.working_dir, "ls-tree", "-r", "--name-only", "-z", tree]
+    ):
+        path = path.decode("utf-8", "replace")
+        if path.endswith("/CMakeLists.txt"):
+            pkgs.add(os.path.dirname(path))
+        elif path.endswith("/requirements"):
+            # Packages that contain CMakeLists.txt files, have them at the top directory of the package
+            # while requirements files are inside a cmt folder, therefore we need to go one level higher
+            # so, we remove the '/cmt' from the end of the path
+            pkgs.add(os.path.dirname(path).rsplit("/", 1)[0])
+    return pkgs
+
+
+def find_remote(repo, commit):
+    """
+    Find the remote a commit comes from, looking at the remote branches and
+    at the tags imported by `git lb-use` (<remote>/<tag>).
+
+    Args:
+        repo (Repo): The repository in which we are looking for the commit
+        commit (String): The commit to look for
+
+    Returns:
+        the name of the remote, or None if the commit is not found
+    """
+    sha = repo.commit(commit).hexsha
+    # usually the commit is the tip of a branch or a tag
+    for ref in repo.git.for_each_ref(
+        "refs/remotes", "refs/tags", points_at=sha, format="%(refname)"
+    ).splitlines():
+        name = ref.split("/", 2)[2]
+        if "/" in name:
+            return name.split("/", 1)[0]
+    # otherwise we take the first branch or tag containing it
+    refs = repo.git.for_each_ref(
+        "refs/remotes/*/*",
+        "refs/tags/*/*",
+        contains=sha,
+        count=1,
+        format="%(refname)",
     )
+    if not refs:
+        return None
+    return refs.split("/", 3)[2]
+
+
+def check_commit(repo, commit):
+    """
+    Check that a commit-ish is valid, exiting with a helpful message if not.
+    """
+    import git
+
+    try:
+        repo.commit(commit)
+    except git.BadName:
+        logging.error("invalid reference: %s", commit)
+        candidates = get_close_matches(
+            commit,
+            [
+                r.name
+                for r in repo.references
+                if isinstance(r, (git.TagReference, git.RemoteReference))
+            ],
+        )
+        if candidates:
+            logging.error(
+                "did you mean this?"
+                if len(candidates) == 1
+                else "did you mean one of these?"
+            )
+            [logging.error("    %s", c) for c in candidates]
+        else:
+            logging.error("did you forget to call 'git lb-use'?")
+        exit(1)
+
+
+def get_checkout_paths(repo, pkgs, path, force=False):
+    """
+    Return the list of packages to check out for a path (a package or a hat),
+    exiting with a helpful message if the path is not valid.
+    """
+    # FIXME: this does not take into account multilevel hats
+    hats = set(os.path.dirname(pkg) for pkg in pkgs)
+
+    path = path.rstrip("/")
+
+    # get the qualified path (if checkout was called from a subdirectory)
+    full_path = os.path.relpath(os.path.join(os.getcwd(), path), repo.working_dir)
+
+    if full_path in pkgs or force:
+        paths = [full_path]
+    elif full_path in hats:
+        hat = full_path + "/"
+        paths = [path for path in pkgs if path.startswith(hat)]
+        paths.sort()
+    else:
+        paths = []
+
+    if not paths:
+        logging.error('"%s" is not a valid path', full_path)
+        candidates = get_close_matches(full_path, list(pkgs) + list(hats))
+        if candidates:
+            logging.error(
+                "did you mean this?"
+                if len(candidates) == 1
+                else "did you mean one of these?"
+            )
+            [logging.error("    %s", c) for c in candidates]
+        exit(1)
+    return paths
+
+
+def update_top_cmake(repo, paths):
+    """
+    Add the paths to the list of subdirectories in the top CMakeLists.txt,
+    if present.
+
+    Returns:
+        the path to the top CMakeLists.txt, or None if it does not exist
+    """
+    top_cmake = os.path.join(repo.working_dir, "CMakeLists.txt")
+    if not os.path.exists(top_cmake):
+        return None
+    # try to add the added subdirectory to the list
+    # - read the top CMakeLists.txt
+    with open(top_cmake) as f:
+        lines = f.readlines()
+    # - look for the subdirectories markers
+    start = end = -1
+    for i, l in enumerate(lines):
+        if start < 0 and "begin: list of subdirectories" in l:
+            start = i
+        elif end < 0 and "end: list of subdirectories" in l:
+            end = i
+    # - if we have something that make sense, we add the
+    #   required lines avoiding duplicates and in alphabetical order
+    if end > start:
+        subdirs = set(l.strip() for l in lines[start + 1 : end])
+        subdirs.update(paths)
+        lines[start + 1 : end] = ["    {}\n".format(l) for l in sorted(subdirs)]
+        with open(top_cmake, "w") as f:
+            f.writelines(lines)
+        repo.index.add([top_cmake])
+    return top_cmake
 
 
 def main():
@@ -90,6 +364,7 @@ def main():
     parser.add_argument(
         "commit",
         metavar="branch",
+        nargs="?",
         help="name of the branch/tag/commit used to get data "
         "from (e.g. LHCb/master)",
     )
@@ -120,6 +395,13 @@ def main():
         help="print the list of packages available from the " "requested branch",
     )
 
+    parser.add_argument(
+        "--from-file",
+        metavar="FILE",
+        help="check out all the packages listed in FILE (one '<branch> <path>' "
+        "per line) with a single commit",
+    )
+
     parser.add_argument(
         "--force",
         action="store_true",
@@ -133,136 +415,76 @@ def main():
     args = parser.parse_args()
     handle_verbosity_argument(args)
 
-    if bool(args.list) == bool(args.path):
+    if args.from_file:
+        if args.commit or args.list:
+            parser.error("--from-file cannot be used with --list, branch or path")
+    elif not args.commit:
+        parser.error("branch not specified")
+    elif bool(args.list) == bool(args.path):
         parser.error("one and only one of --list and path should be specified")
 
+    import git
+
     try:
         repo = git.Repo(search_parent_directories=True)
     except git.InvalidGitRepositoryError:
         logging.error("current directory is not a Git repository")
         exit(1)
 
-    # check that the commit-ish is valid
     try:
-        repo.commit(args.commit)
-    except git.BadName:
-        logging.error("invalid reference: %s", args.commit)
-        candidates = get_close_matches(
-            args.commit,
-            [
-                r.name
-                for r in repo.references
-                if isinstance(r, (git.TagReference, git.RemoteReference))
-            ],
+        entries = (
+            read_manifest(args.from_file)
+            if args.from_file
+            else [(args.commit, args.path)]
         )
-        if candidates:
-            logging.error(
-                "did you mean this?"
-                if len(candidates) == 1
-                else "did you mean one of these?"
-            )
-            [logging.error("    %s", c) for c in candidates]
-        else:
-            logging.error("did you forget to call 'git lb-use'?")
+    except (IOError, ValueError) as err:
+        logging.error("%s", err)
         exit(1)
+    if not entries:
+        logging.warning("nothing to check out")
+        return
 
-    if "/" in args.commit:
-        remote = args.commit.split("/", 1)[0]
-    else:  # find the remote containing the commit
-        from itertools import chain
-
-        # try with branches and tags
-        remotes = chain(
-            # try with branches
-            (
-                l.strip().split("/", 1)[0]
-                for l in repo.git.branch(
-                    remotes=True, contains=args.commit
-                ).splitlines()
-                if "/" in l
-            ),
-            # try with tags
-            (
-                l.strip().split("/", 1)[0]
-                for l in repo.git.tag(contains=args.commit).splitlines()
-                if "/" in l
-            ),
-        )
-        try:
-            remote = next(remotes)
-        except StopIteration:
-            logging.error(
-                "cannot find the remote repository containing %s", args.commit
-            )
-            exit(1)
+    # check that the commit-ishes are valid
+    for commit in set(commit for commit, _ in entries):
+        check_commit(repo, commit)
 
     try:
-        pkgs = get_packages_of(repo, args.commit)
-
         if args.list:
-            print("\n".join(sorted(pkgs)))
+            print("\n".join(sorted(get_packages_of(repo, args.commit))))
             return
 
-        # FIXME: this does not take into account multilevel hats
-        hats = set(os.path.dirname(pkg) for pkg in pkgs)
-
-        args.path = args.path.rstrip("/")
-
-        # get the qualified path (if checkout was called from a subdirectory)
-        full_path = os.path.relpath(
-            os.path.join(os.getcwd(), args.path), repo.working_dir
-        )
-
-        if full_path in pkgs or args.force:
-            paths = [full_path]
-        elif full_path in hats:
-            hat = full_path + "/"
-            paths = [path for path in pkgs if path.startswith(hat)]
-            paths.sort()
-        else:
-            paths = []
-
-        if not paths:
-            logging.error('"%s" is not a valid path', full_path)
-            candidates = get_close_matches(full_path, list(pkgs) + list(hats))
-            if candidates:
-                logging.error(
-                    "did you mean this?"
-                    if len(candidates) == 1
-                    else "did you mean one of these?"
-                )
-                [logging.error("    %s", c) for c in candidates]
-            exit(1)
+        # group the paths by commit, so that we check out each commit once
+        groups = OrderedDict()
+        for commit, path in entries:
+            if commit not in groups:
+                if "/" in commit:
+                    remote = commit.split("/", 1)[0]
+                else:  # find the remote containing the commit
+                    remote = find_remote(repo, commit)
+                    if not remote:
+                        logging.error(
+                            "cannot find the remote repository containing %s", commit
+                        )
+                        exit(1)
+                groups[commit] = (remote, get_packages_of(repo, commit), [])
+            _, pkgs, paths = groups[commit]
+            paths.extend(
+                p
+                for p in get_checkout_paths(repo, pkgs, path, args.force)
+                if p not in paths
+            )
+        checkouts = [
+            (commit, remote, paths) for commit, (remote, _, paths) in groups.items()
+        ]
+        paths = [path for _, _, entry_paths in checkouts for path in entry_paths]
 
         configfile = os.path.join(repo.working_dir, ".git-lb-checkout")
 
-        for path in paths:
-            _checkout(repo, args.commit, remote, path, configfile)
+        _checkout(repo, checkouts, configfile)
 
         repo.index.add([configfile])
 
-        top_cmake = os.path.join(repo.working_dir, "CMakeLists.txt")
-        if os.path.exists(top_cmake):
-            # try to add the added subdirectory to the list
-            # - read the top CMakeLists.txt
-            with open(top_cmake) as f:
-                lines = f.readlines()
-            # - look for the subdirectories markers
-            start = end = -1
-            for i, l in enumerate(lines):
-                if start < 0 and "begin: list of subdirectories" in l:
-                    start = i
-                elif end < 0 and "end: list of subdirectories" in l:
-                    end = i
-            # - if we have something that make sense, we add the
-            #   required lines avoiding duplicates and in alphabetical order
-            if end > start:
-                subdirs = set(l.strip() for l in lines[start + 1 : end])
-                subdirs.update(paths)
-                lines[start + 1 : end] = ["    {}\n".format(l) for l in sorted(subdirs)]
-                with open(top_cmake, "w") as f:
-                    f.writelines(lines)
-                repo.index.add([top_cmake])
+        top_cmake = update_top_cmake(repo, paths)
 
         diffs = repo.head.commit.diff()
 
@@ -271,23 +493,34 @@ def main():
             return
 
         if args.do_commit:
-            if len(paths) == 1:
+            if len(checkouts) > 1:
+                msg = "added packages:\n - {}".format(
+                    "\n - ".join(
+                        "{} from {} ({})".format(path, remote, commit)
+                        for commit, remote, entry_paths in checkouts
+                        for path in entry_paths
+                    )
+                )
+            elif len(paths) == 1:
                 msg = "added {path} from {remote} ({commit})".format(
-                    path=paths[0], remote=remote, commit=args.commit
+                    path=paths[0], remote=checkouts[0][1], commit=checkouts[0][0]
                 )
             else:
                 msg = "added from {remote} ({commit}):\n - {paths}".format(
-                    remote=remote, commit=args.commit, paths="\n - ".join(paths)
+                    remote=checkouts[0][1],
+                    commit=checkouts[0][0],
+                    paths="\n - ".join(paths),
                 )
             repo.index.commit(msg)
 
-        logging.info(
-            "checked out %s from %s (%s)", ", ".join(paths), remote, args.commit
-        )
+        for commit, remote, entry_paths in checkouts:
+            logging.info(
+                "checked out %s from %s (%s)", ", ".join(entry_paths), remote, commit
+            )
         if args.log_level <= logging.DEBUG:
             [logging.debug(" %s  %s", d.change_type, d.b_path) for d in diffs]
 
-        if os.path.exists(top_cmake):
+        if top_cmake:
             # "touch" top CMakeLists.txt to make sure we force a reconfigure
             os.utime(top_cmake, None)
 
@@ -12,7 +12,6 @@ from __future__ import absolute_import
 
 __author__ = "Marco Clemencic <marco.clemencic@cern.ch>"
 
-import git
 import logging
 from subprocess import CalledProcessError
 from LbDevTools.GitTools.common import (
@@ -26,6 +25,8 @@ from LbDevTools.GitTools.common import (
 
 
 def get_latest_tag(repo):
+    import git
+
     try:
         return repo.git.describe(match="v*", abbrev=0, tags=True)
     except git.GitCommandError:
@@ -82,6 +83,8 @@ def main():
     if not args.url:
         args.url = package_url(args.name, args.protocol)
 
+    import git
+
     try:
         logging.info("cloning %s@%s to %s", args.url, args.branch, args.name)
         repo = git.Repo.clone_from(args.url, args.name, branch=args.branch)
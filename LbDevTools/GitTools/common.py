@@ -10,6 +10,8 @@
 ###############################################################################
 from __future__ import absolute_import
 
+import argparse
+
 __author__ = "Marco Clemencic <marco.clemencic@cern.ch>"
 
 PROTOCOLS_URLS = {
@@ -125,10 +127,35 @@ def handle_verbosity_argument(args):
     logging.basicConfig(level=args.log_level)
 
 
-def add_version_argument(parser):
-    from LbDevTools import __version__
+class VersionAction(argparse.Action):
+    """
+    Same as the standard "version" action of argparse, but looking up the
+    version of LbDevTools only if the option is used (it is slow).
+    """
 
-    parser.add_argument(
-        "--version", action="version", version="%(prog)s {}".format(__version__)
-    )
+    def __init__(
+        self,
+        option_strings,
+        dest=argparse.SUPPRESS,
+        default=argparse.SUPPRESS,
+        help="show program's version number and exit",
+    ):
+        super(VersionAction, self).__init__(
+            option_strings=option_strings,
+            dest=dest,
+            default=default,
+            nargs=0,
+            help=help,
+        )
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        import sys
+        from LbDevTools import __version__
+
+        sys.stdout.write("{} {}\n".format(parser.prog, __version__))
+        parser.exit()
+
+
+def add_version_argument(parser):
+    parser.add_argument("--version", action=VersionAction)
     return parser
@@ -14,7 +14,6 @@ from __future__ import print_function
 __author__ = "Marco Clemencic <marco.clemencic@cern.ch>"
 
 import os
-import git
 import logging
 from functools import cmp_to_key
 from collections import defaultdict
@@ -170,6 +169,8 @@ def main():
     args = parser.parse_args()
     handle_verbosity_argument(args)
 
+    import git
+
     try:
         repo = git.Repo(search_parent_directories=True)
     except git.InvalidGitRepositoryError:
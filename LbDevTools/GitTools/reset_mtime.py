@@ -17,7 +17,6 @@ import argparse
 import os
 import sys
 import time
-from git import Repo
 
 
 def build_file_list(rootdir, fileset):
@@ -41,6 +40,8 @@ def main():
     )
     args = parser.parse_args()
 
+    from git import Repo
+
     # Created the Repo and collect the list of files in the workdir
     with Repo(args.repopath) as repo:
         if repo.is_dirty():
@@ -12,8 +12,9 @@ from __future__ import absolute_import
 
 __author__ = "Marco Clemencic <marco.clemencic@cern.ch>"
 
-import git
 import logging
+import os
+import re
 from argparse import ArgumentParser
 from LbEnv import fixProjectCase
 from LbDevTools.GitTools.common import (
@@ -25,6 +26,110 @@ from LbDevTools.GitTools.common import (
     project_url,
 )
 
+# number of attempts for fetches failing because a concurrent fetch in the
+# same repository holds a lock (e.g. on packed-refs)
+FETCH_RETRIES = 5
+LOCK_ERROR = re.compile(r"\.lock\b|cannot lock ref")
+
+
+def get_satellite_projects(path):
+    """
+    Return the projects a satellite project (created with lb-dev) depends on.
+
+    Args:
+        path (String): The top directory of the satellite project
+
+    Returns:
+        a list of project names
+    """
+    import re
+    from glob import glob
+
+    projects = []
+    # CMake configuration (cmake/<Name>Dependencies.cmake)
+    for filename in sorted(glob(os.path.join(path, "cmake", "*Dependencies.cmake"))):
+        with open(filename) as f:
+            projects.extend(
+                re.findall(r"^\s*lhcb_find_package\(\s*(\w+)", f.read(), re.M)
+            )
+    # legacy CMake configuration (gaudi_project(... USE <Project> <version> ...))
+    if not projects and os.path.exists(os.path.join(path, "CMakeLists.txt")):
+        with open(os.path.join(path, "CMakeLists.txt")) as f:
+            m = re.search(
+                r"^\s*gaudi_project\(.*?\bUSE\b(.*?)(?:\b[A-Z_]+\b|\))",
+                f.read(),
+                re.M | re.S,
+            )
+        if m:
+            projects.extend(m.group(1).split()[::2])
+    return projects
+
+
+def configure_remote(repo, project, url, tags_matching=None, partial_filter=None):
+    """
+    Define the remote 'project' pointing to 'url', replacing any existing
+    remote with the same name.
+    """
+    logging.info("calling: git remote add -f '%s' '%s'", project, url)
+
+    # define a remote "$project", overwrite it if it already exists
+    try:
+        old_url = repo.remote(project).url
+        # the remote is defined
+        logging.warning("overwriting existing remote '%s' (was %s)", project, old_url)
+        repo.delete_remote(project)
+    except ValueError:  # remote does not exist
+        pass
+
+    repo.create_remote(project, url)
+    # GitPython config writer drops the repeated options (like 'fetch') of
+    # other sections, so we use 'git config'
+    repo.git.config("remote.{}.tagopt".format(project), "--no-tags")
+    if partial_filter:
+        # missing objects will be fetched from this remote
+        repo.git.config("remote.{}.promisor".format(project), "true")
+        repo.git.config("remote.{}.partialclonefilter".format(project), partial_filter)
+    for pattern in tags_matching or ["*"]:
+        repo.git.config(
+            "remote.{}.fetch".format(project),
+            "+refs/tags/{1}:refs/tags/{0}/{1}".format(project, pattern),
+            add=True,
+        )
+
+
+def fetch_remote(path, project, **fetch_options):
+    """
+    Fetch branches and tags of the remote 'project' in the repository at
+    'path', retrying if a concurrent fetch holds a lock.
+
+    Returns:
+        a tuple with the lists of branches and tags of the remote
+    """
+    import git
+    import time
+
+    # each thread needs its own instance of Repo
+    repo = git.Repo(path)
+    if repo.git.version_info >= (2, 29):
+        # concurrent fetches would all write FETCH_HEAD
+        fetch_options = dict(fetch_options, no_write_fetch_head=True)
+    for attempt in range(FETCH_RETRIES):
+        try:
+            repo.git.fetch(project, **fetch_options)
+            break
+        except git.GitCommandError as err:
+            if attempt + 1 == FETCH_RETRIES or not LOCK_ERROR.search(str(err)):
+                raise
+            logging.debug("%s: lock held by another fetch, retrying", project)
+            time.sleep(0.2 * 2 ** attempt)
+    branches = repo.git.for_each_ref(
+        "refs/remotes/{}".format(project), format="%(refname:short)"
+    ).split()
+    tags = repo.git.for_each_ref(
+        "refs/tags/{}".format(project), format="%(refname:short)"
+    ).split()
+    return branches, tags
+
 
 def main():
     """
@@ -34,12 +139,45 @@ def main():
     parser = ArgumentParser(prog="git lb-use")
     add_version_argument(parser)
 
-    parser.add_argument("project", help="project which history to fetch")
     parser.add_argument(
-        "url",
-        nargs="?",
+        "projects",
+        nargs="*",
+        metavar="project",
+        help="projects which history to fetch (by default the projects the "
+        "current satellite project depends on)",
+    )
+    parser.add_argument(
+        "--url",
         metavar="repository_url",
-        help="alternative repository to use, instead of the " "standard one",
+        help="alternative repository to use, instead of the standard one "
+        "(only with one project, for backward compatibility it can also be "
+        "passed as second argument)",
+    )
+
+    parser.add_argument(
+        "--filter",
+        metavar="FILTER_SPEC",
+        help="fetch only part of the objects (e.g. blob:none), the missing "
+        "ones are fetched when needed (see `git help rev-list`)",
+    )
+    parser.add_argument(
+        "--depth",
+        type=int,
+        help="fetch only the last DEPTH commits of the history",
+    )
+    parser.add_argument(
+        "--tags-matching",
+        action="append",
+        metavar="PATTERN",
+        help="fetch only the tags matching PATTERN (e.g. 'v50r*'), "
+        "can be repeated (default: all tags)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=4,
+        help="number of projects to fetch in parallel (default: %(default)s)",
     )
 
     add_protocol_argument(parser)
@@ -48,6 +186,18 @@ def main():
     args = parser.parse_args()
     handle_verbosity_argument(args)
 
+    # backward compatibility: git lb-use <project> <url>
+    if (
+        len(args.projects) == 2
+        and not args.url
+        and ("/" in args.projects[1] or ":" in args.projects[1])
+    ):
+        args.url = args.projects.pop()
+    if args.url and len(args.projects) != 1:
+        parser.error("an alternative url can be used only with one project")
+
+    import git
+
     try:
         repo = git.Repo(search_parent_directories=True)
     except git.InvalidGitRepositoryError:
@@ -56,54 +206,86 @@ def main():
 
     handle_protocol_argument(args, repo)
 
-    project = fixProjectCase(args.project)
-    if args.project != project:
-        logging.warning("misspelled project name, using %s instead", project)
-        args.project = project
-    del project
+    if not args.projects:
+        args.projects = get_satellite_projects(repo.working_dir)
+        if not args.projects:
+            parser.error("no project specified and no dependency found")
+        logging.info("using projects: %s", ", ".join(args.projects))
 
-    if not args.url:
-        args.url = project_url(args.project, args.protocol)
+    projects = []
+    for name in args.projects:
+        project = fixProjectCase(name)
+        if name != project:
+            logging.warning("misspelled project name, using %s instead", project)
+        if project not in projects:
+            projects.append(project)
 
-    logging.info("calling: git remote add -f '%s' '%s'", args.project, args.url)
+    fetch_options = {}
+    if args.filter:
+        fetch_options["filter"] = args.filter
+    if args.depth:
+        fetch_options["depth"] = args.depth
+        # git cannot update the list of shallow commits concurrently
+        args.jobs = 1
 
-    # define a remote "$project", overwrite it if it already exists
     try:
-        old_url = repo.remote(args.project).url
-        # the remote is defined
-        logging.warning(
-            "overwriting existing remote '%s' (was %s)", args.project, old_url
-        )
-        repo.delete_remote(args.project)
-    except ValueError:  # remote does not exist
-        pass
-
-    try:
-        remote = repo.create_remote(args.project, args.url)
-        with remote.config_writer as conf:
-            conf.set("tagopt", "--no-tags")
-        # FIXME 'git config --add' is not supported bug GitPython
-        repo.git.config(
-            "remote.{}.fetch".format(args.project),
-            "+refs/tags/*:refs/tags/{}/*".format(args.project),
-            add=True,
-        )
-        refs = remote.fetch()
-
-        TAGS = True
-        BRANCHES = False
-        groups = {TAGS: [], BRANCHES: []}
-        for ref in refs:
-            groups[hasattr(ref.ref, "tag")].append(ref)
-        logging.info(
-            "fetched %d branches and %d tags", len(groups[BRANCHES]), len(groups[TAGS])
-        )
-        if groups[BRANCHES]:
-            logging.debug("Branches:")
-            [logging.debug(" - %s", ref.name) for ref in groups[BRANCHES]]
-        if groups[TAGS]:
-            logging.debug("Tags:")
-            [logging.debug(" - %s", ref.name) for ref in groups[TAGS]]
+        # the remotes are configured one by one, in the order requested
+        for project in projects:
+            configure_remote(
+                repo,
+                project,
+                args.url or project_url(project, args.protocol),
+                args.tags_matching,
+                args.filter,
+            )
     except Exception as err:
         logging.error("%s: %s", type(err).__name__, err)
         exit(1)
+
+    from multiprocessing.pool import ThreadPool
+
+    def fetch(project):
+        try:
+            return project, fetch_remote(repo.working_dir, project, **fetch_options)
+        except Exception as err:
+            return project, err
+
+    pool = ThreadPool(max(1, min(args.jobs, len(projects))))
+    failed = []
+    try:
+        for count, (project, result) in enumerate(
+            pool.imap_unordered(fetch, projects), 1
+        ):
+            if isinstance(result, Exception):
+                logging.error(
+                    "(%d/%d) %s: %s: %s",
+                    count,
+                    len(projects),
+                    project,
+                    type(result).__name__,
+                    result,
+                )
+                failed.append(project)
+                continue
+            branches, tags = result
+            logging.info(
+                "(%d/%d) %s: fetched %d branches and %d tags",
+                count,
+                len(projects),
+                project,
+                len(branches),
+                len(tags),
+            )
+            if branches:
+                logging.debug("Branches:")
+                [logging.debug(" - %s", ref) for ref in branches]
+            if tags:
+                logging.debug("Tags:")
+                [logging.debug(" - %s", ref) for ref in tags]
+    finally:
+        pool.close()
+        pool.join()
+
+    if failed:
+        logging.error("failed to fetch %s", ", ".join(sorted(failed)))
+        exit(1)
@@ -25,15 +25,31 @@ import itertools
 import json
 import logging
 import datetime
-import gitlab
 from collections import OrderedDict
-from jinja2 import Environment, FileSystemLoader
+from threading import Lock
 
 import subprocess
 
-from LbDevTools import __version__
 import six
 
+GITLAB_URL = "https://gitlab.cern.ch/"
+# maximum number of concurrent requests to GitLab
+GITLAB_JOBS = 8
+# number of items per page (and of merge requests per query) in GitLab queries
+GITLAB_PAGE_SIZE = 100
+# number of attempts for GitLab queries failing because of rate limits or
+# transient server errors (HTTP codes)
+GITLAB_RETRIES = 5
+GITLAB_TRANSIENT_ERRORS = (429, 500, 502, 503, 504)
+# trailer added by GitLab to the message of merge commits
+MERGE_REQUEST_TRAILER = re.compile(
+    r"^See merge request ([^ ]*)!([0-9]+)$", re.MULTILINE
+)
+# local refs where the heads of the merge requests are fetched
+MERGE_REQUEST_REFS = "refs/remotes/origin/merge-requests"
+# file (in the git directory) listing the merge commits without merge request
+UNMATCHED_MERGES = "lb-release-notes-unmatched"
+
 
 def rel_project_path(path, to):
     """Return the common path component.
@@ -100,15 +116,268 @@ def ref_names(repo, commit):
     return [x.strip() for x in result[1:-1].split(",")]
 
 
-def find_merge_request_id(repo, merge_commit, second_parent):
+def merge_request_refs(repo):
+    """
+    Return a dictionary mapping commit ids to the names of the merge request
+    refs (refs/remotes/origin/merge-requests/*) pointing to them.
+    """
+    refs = {}
+    output = git_o(
+        [
+            "for-each-ref",
+            "--format=%(objectname) %(refname)",
+            MERGE_REQUEST_REFS,
+        ],
+        cwd=repo,
+    )
+    for line in output.splitlines():
+        commit, name = line.split(" ", 1)
+        refs.setdefault(commit, []).append(name)
+    return refs
+
+
+def get_gitlab_server(url=GITLAB_URL, token=None, jobs=GITLAB_JOBS):
+    """
+    Return a gitlab.Gitlab instance using large pages and one HTTP session
+    with enough connections for 'jobs' concurrent requests.
+    """
+    import gitlab
+    import requests
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=jobs, pool_maxsize=jobs)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return gitlab.Gitlab(url, token, session=session, per_page=GITLAB_PAGE_SIZE)
+
+
+class GitLabFetcher(object):
+    """
+    Run GitLab queries concurrently on a bounded pool of threads, retrying
+    (with exponential backoff) those failing because of rate limits or
+    transient server errors.
+
+    Functions run in the pool must not use the pool (map, submit or spawn)
+    again, but they can use call.
+    """
+
+    def __init__(self, jobs=GITLAB_JOBS, retries=GITLAB_RETRIES, backoff=0.5):
+        from multiprocessing.pool import ThreadPool
+
+        self.retries = retries
+        self.backoff = backoff
+        self._pool = ThreadPool(jobs)
+
+    def call(self, func, *args, **kwargs):
+        """
+        Return func(*args, **kwargs), retrying on transient errors.
+        """
+        import gitlab
+        import time
+
+        for attempt in range(self.retries):
+            try:
+                return func(*args, **kwargs)
+            except gitlab.GitlabError as err:
+                if (
+                    err.response_code not in GITLAB_TRANSIENT_ERRORS
+                    or attempt + 1 == self.retries
+                ):
+                    raise
+                delay = self.backoff * 2 ** attempt
+                logging.debug("GitLab error %s, retry in %ss", err, delay)
+                time.sleep(delay)
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Schedule a call to func(*args, **kwargs) and return an object whose
+        method get() returns the result.
+        """
+        return self._pool.apply_async(self.call, (func,) + args, kwargs)
+
+    def spawn(self, func, *args, **kwargs):
+        """
+        Same as submit, but without retries, for functions making several
+        queries (each retried via call).
+        """
+        return self._pool.apply_async(func, args, kwargs)
+
+    def map(self, func, items):
+        """
+        Return [func(item) for item in items], calling func concurrently.
+        """
+        return self._pool.map(lambda item: self.call(func, item), items)
+
+    def merge_requests(self, project, iids):
+        """
+        Return the merge requests of a project with the given iids.
+        """
+        chunks = [
+            iids[i : i + GITLAB_PAGE_SIZE]
+            for i in range(0, len(iids), GITLAB_PAGE_SIZE)
+        ]
+        # .list(iids=iids) produces a wrong query, so do it semi-manually:
+        # TODO fix this in a future version of python-gitlab
+        return list(
+            itertools.chain.from_iterable(
+                self.map(
+                    lambda chunk: project.mergerequests.list(
+                        all=True, per_page=GITLAB_PAGE_SIZE, **{"iids[]": chunk}
+                    ),
+                    chunks,
+                )
+            )
+        )
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+
+class CachedMergeRequest(object):
+    """
+    Merge request data retrieved from a MergeRequestCache.
+    """
+
+    def __init__(self, data):
+        self.__dict__.update(data)
+
+    def __repr__(self):
+        return "<CachedMergeRequest {}>".format(self.reference)
+
+
+class MergeRequestCache(object):
+    """
+    Persistent record of the fields of GitLab merge requests used in release
+    notes, keyed by project full name and iid, and of the merge requests
+    associated to milestones.
+
+    Entries are replaced only by more recent versions of the merge requests
+    (according to 'updated_at').
+    """
+
+    FIELDS = (
+        "id",
+        "iid",
+        "title",
+        "description",
+        "labels",
+        "reference",
+        "web_url",
+        "state",
+        "updated_at",
+    )
+
+    def __init__(self, path):
+        self.path = path
+        self._merge_requests = {}
+        self._milestones = {}
+        self._modified = False
+        self._lock = Lock()
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            self._merge_requests = data["merge_requests"]
+            self._milestones = data["milestones"]
+        except (IOError, ValueError, KeyError, TypeError):
+            pass  # missing or invalid cache file, start from scratch
+
+    @staticmethod
+    def _key(project_fullname, iid):
+        return "{}!{}".format(project_fullname, iid)
+
+    def add(self, project_fullname, mr):
+        """
+        Record the merge request 'mr' of the project 'project_fullname'.
+        """
+        data = dict((field, getattr(mr, field, None)) for field in self.FIELDS)
+        author = getattr(mr, "author", None) or {}
+        data["author"] = {"username": author.get("username")}
+        key = self._key(project_fullname, data["iid"])
+        with self._lock:
+            cached = self._merge_requests.get(key)
+            if cached is None or (cached["updated_at"] or "") <= (
+                data["updated_at"] or ""
+            ):
+                if cached != data:
+                    self._merge_requests[key] = data
+                    self._modified = True
+
+    def get(self, project_fullname, iid):
+        """
+        Return the cached merge request or None.
+        """
+        data = self._merge_requests.get(self._key(project_fullname, iid))
+        return CachedMergeRequest(data) if data else None
+
+    def set_milestone(self, project_fullname, milestone, iids):
+        """
+        Record the iids of the merge requests with a given milestone.
+        """
+        key = "{}%{}".format(project_fullname, milestone)
+        with self._lock:
+            if self._milestones.get(key) != iids:
+                self._milestones[key] = iids
+                self._modified = True
+
+    def milestone(self, project_fullname, milestone):
+        """
+        Return the iids of the merge requests with a given milestone, or None
+        if not known.
+        """
+        return self._milestones.get("{}%{}".format(project_fullname, milestone))
+
+    def save(self):
+        """
+        Write the cache to disk (if it changed).
+        """
+        from LbDevTools.SourceTools import write_file_atomically
+
+        if not self._modified:
+            return
+        try:
+            write_file_atomically(
+                self.path,
+                json.dumps(
+                    {
+                        "merge_requests": self._merge_requests,
+                        "milestones": self._milestones,
+                    },
+                    indent=1,
+                    sort_keys=True,
+                ),
+            )
+            self._modified = False
+        except (IOError, OSError) as err:
+            logging.warning("cannot write %s: %s", self.path, err)
+
+
+def get_merge_request_cache_path():
+    """
+    Return the default location of the cache of merge requests.
+    """
+    from LbDevTools.SourceTools import get_user_cache_dir
+
+    return os.path.join(get_user_cache_dir(), "lb-gen-release-notes.json")
+
+
+def find_merge_request_id(
+    repo, merge_commit, second_parent, mr_refs=None, message=None
+):
     """
     Find a merge request iid given a merge commit and its second parent.
 
     First tries to match the second parent to a merge request ref name.
     If this fails (e.g. for squashed commits), a match is attempted
     based on the merge commit message.
+
+    The map of merge request refs (see merge_request_refs) and the message
+    of the merge commit can be passed to avoid querying git.
     """
-    names = ref_names(repo, second_parent)
+    if mr_refs is not None:
+        names = mr_refs.get(second_parent, [])
+    else:
+        names = ref_names(repo, second_parent)
     m = [
         re.match(r"^refs/remotes/origin/merge-requests/(\d+)$", name) for name in names
     ]
@@ -127,10 +396,11 @@ def find_merge_request_id(repo, merge_commit, second_parent):
     # For squashed commits, the MR reference stays at the last MR commit
     # while the second parent is the new squashed commit. It is hard to
     # precisely match the commits, so let's look at the merge commit message
-    message = git_o(["show", "-s", "--format=%B", merge_commit], cwd=repo)
-    m = re.search("^See merge request [^ ]*!([0-9]+)$", message, re.MULTILINE)
+    if message is None:
+        message = git_o(["show", "-s", "--format=%B", merge_commit], cwd=repo)
+    m = MERGE_REQUEST_TRAILER.search(message)
     if m:
-        return int(m.group(1))
+        return int(m.group(2))
     logging.warning(
         "Could not find MR for {} based on second parent ({}) refs or commit "
         "message.\nDid you squash _and_ modify message or did you even push "
@@ -139,39 +409,136 @@ def find_merge_request_id(repo, merge_commit, second_parent):
     return None
 
 
-def find_merge_requests_git(project, repo, since, until=""):
+def fetch_merge_request_refs(repo, iids=None):
     """
-    Find GitLab merge requests using the git commit history.
+    Fetch the heads of the merge requests from the origin remote.
+
+    If a list of 'iids' is given, only those merge requests are fetched,
+    otherwise all of them.
     """
-    git(
-        [
-            "fetch",
-            "-q",
-            "origin",
-            "+refs/merge-requests/*/head:refs/remotes/origin/merge-requests/*",
-        ],
-        cwd=repo,
-    )
+    if iids is None:
+        refspecs = ["+refs/merge-requests/*/head:{}/*".format(MERGE_REQUEST_REFS)]
+    else:
+        refspecs = [
+            "+refs/merge-requests/{0}/head:{1}/{0}".format(iid, MERGE_REQUEST_REFS)
+            for iid in sorted(iids)
+        ]
+        if not refspecs:
+            return
+    logging.debug("fetching %d merge request refs", len(refspecs))
+    git(["fetch", "-q", "origin"] + refspecs, cwd=repo)
+
+
+def find_merge_request_iids(repo, since, until="", fetch=True):
+    """
+    Find the iids of the merge requests merged in the git commit history.
+
+    If 'fetch' is False, the merge requests refs are not updated from the
+    origin remote (no network access). If it is "narrow", only the missing
+    refs of the merge requests mentioned in the merge commits are fetched,
+    falling back on fetching all of them if some merge commits cannot be
+    matched to a merge request.
+    """
+    # get ids, parents and messages of all merge commits in one go
     log = git_o(
         [
             "log",
+            "-z",
             "--first-parent",
-            "--parents",
             "--merges",
-            "--pretty=oneline",
+            "--format=%H%x00%P%x00%B",
             "--no-color",
             "{}..{}".format(since, until),
         ],
         cwd=repo,
     )
-    commits = [line.split()[:3] for line in log.splitlines()]
-    iids = [find_merge_request_id(repo, commit[0], commit[2]) for commit in commits]
-    iids = [iid for iid in iids if iid]
-    # .list(iids=iids) produces a wrong query, so do it semi-manually:
-    # TODO fix this in a future version of python-gitlab
-    mrs = []
-    for i in range(0, len(iids), 10):
-        mrs += project.mergerequests.list(all=True, **{"iids[]": iids[i : i + 10]})
+    fields = log.split("\0") if log else []
+    merges = [
+        (commit, parents.split()[1], message)
+        for commit, parents, message in zip(fields[::3], fields[1::3], fields[2::3])
+    ]
+
+    if fetch == "narrow":
+        mr_refs = merge_request_refs(repo)
+        # the merge request refs we already have locally are not fetched
+        # again, as the head of a merged merge request does not change
+        known = set(
+            int(name.rsplit("/", 1)[1]) for names in mr_refs.values() for name in names
+        )
+        # trailers referring to merge requests of other projects (e.g. in
+        # merged upstream history) are ignored
+        project_fullname = find_project_fullname(repo).lower()
+        wanted = set(
+            int(m.group(2))
+            for m in (MERGE_REQUEST_TRAILER.search(msg) for _, _, msg in merges)
+            if m and m.group(1).lower() in ("", project_fullname)
+        )
+        try:
+            if wanted - known:
+                fetch_merge_request_refs(repo, wanted - known)
+                mr_refs = merge_request_refs(repo)
+            fetched = True
+        except subprocess.CalledProcessError:
+            # e.g. a merge request removed from the server
+            fetched = False
+        # merge commits without trailer can only be matched via the refs
+        # (we remember those that could not be matched even after fetching
+        # all refs, typically branches merged from the command line)
+        record = os.path.join(
+            repo, git_o(["rev-parse", "--git-path", UNMATCHED_MERGES], cwd=repo)
+        )
+        try:
+            with open(record) as f:
+                known_unmatched = set(f.read().split())
+        except IOError:
+            known_unmatched = set()
+
+        def unmatched():
+            return set(
+                commit
+                for commit, parent, msg in merges
+                if parent not in mr_refs and not MERGE_REQUEST_TRAILER.search(msg)
+            )
+
+        if not fetched or unmatched() - known_unmatched:
+            logging.info(
+                "cannot identify all merge requests from the merge commits, "
+                "fetching all merge request refs"
+            )
+            fetch_merge_request_refs(repo)
+            mr_refs = merge_request_refs(repo)
+            with open(record, "w") as f:
+                f.writelines(
+                    commit + "\n" for commit in sorted(known_unmatched | unmatched())
+                )
+    else:
+        if fetch:
+            fetch_merge_request_refs(repo)
+        mr_refs = merge_request_refs(repo)
+
+    iids = [
+        find_merge_request_id(repo, commit, parent, mr_refs=mr_refs, message=message)
+        for commit, parent, message in merges
+    ]
+    return [iid for iid in iids if iid]
+
+
+def find_merge_requests_git(project, repo, since, until="", fetcher=None, fetch=True):
+    """
+    Find GitLab merge requests using the git commit history.
+
+    The merge requests are retrieved with the GitLabFetcher 'fetcher', if
+    provided. See find_merge_request_iids for the meaning of 'fetch'.
+    """
+    iids = find_merge_request_iids(repo, since, until, fetch=fetch)
+    if fetcher:
+        mrs = fetcher.merge_requests(project, iids)
+    else:
+        # .list(iids=iids) produces a wrong query, so do it semi-manually:
+        # TODO fix this in a future version of python-gitlab
+        mrs = []
+        for i in range(0, len(iids), 10):
+            mrs += project.mergerequests.list(all=True, **{"iids[]": iids[i : i + 10]})
     if len(mrs) != len(iids):
         raise RuntimeError(
             "Could not list all {} MRs, got {}".format(len(iids), len(mrs))
@@ -198,14 +565,23 @@ def guess_project_fullname(name):
     return ("gaudi/" if name == "Gaudi" else "lhcb/") + name
 
 
-def find_merge_requests_milestone(project, milestone_title):
+def find_merge_requests_milestone(project, milestone_title, fetcher=None):
     """
     Find GitLab merge requests with a given milestone.
+
+    If a GitLabFetcher is provided, it is used to retry failing queries.
     """
+    import gitlab
+
+    call = (
+        fetcher.call
+        if fetcher
+        else (lambda func, *args, **kwargs: func(*args, **kwargs))
+    )
     try:
         milestones = [
             m
-            for m in project.milestones.list(search=milestone_title)
+            for m in call(project.milestones.list, search=milestone_title)
             if m.title == milestone_title
         ]
     except gitlab.GitlabAuthenticationError:
@@ -220,15 +596,14 @@ def find_merge_requests_milestone(project, milestone_title):
         )
         return []
     elif len(milestones) > 1:
-        logging.error(
+        raise ValueError(
             "Multiple milestones {} found in GitLab project {}".format(
                 milestone_title, project.name
             )
         )
-        sys.exit(1)
 
     milestone = milestones[0]
-    return list(milestone.merge_requests())
+    return call(lambda: list(milestone.merge_requests(per_page=GITLAB_PAGE_SIZE)))
 
 
 def find_merge_request_issues(mr, project_fullname):
@@ -254,12 +629,75 @@ def find_merge_request_issues(mr, project_fullname):
     return sorted(set(gl_issues)) + sorted(set(jira_tasks))
 
 
-def find_merge_requests(server, repo, since, milestone):
-    """"""
+def find_merge_requests_cache(cache, project_fullname, repo, since, milestone):
+    """
+    Same as find_merge_requests_git and find_merge_requests_milestone, but
+    only using the local git repository and the MergeRequestCache 'cache'.
+    """
+    git_mrs = []
+    for iid in find_merge_request_iids(repo, since, fetch=False):
+        mr = cache.get(project_fullname, iid)
+        if mr:
+            git_mrs.append(mr)
+        else:
+            logging.error(
+                "MR {}!{} not found in the cache".format(project_fullname, iid)
+            )
+    # GitLab returns the most recent first
+    git_mrs.sort(key=lambda mr: -mr.iid)
+    gitlab_mrs = [
+        cache.get(project_fullname, iid)
+        for iid in cache.milestone(project_fullname, milestone) or []
+    ]
+    return git_mrs, [mr for mr in gitlab_mrs if mr]
+
+
+def find_merge_requests(
+    server,
+    repo,
+    since,
+    milestone,
+    fetcher=None,
+    cache=None,
+    offline=False,
+    fetch=True,
+):
+    """
+    Find the merge requests merged in a repository since a given version and
+    those with a given milestone.
+
+    With a GitLabFetcher, the GitLab queries are run concurrently.
+
+    The merge requests found are recorded in the MergeRequestCache 'cache',
+    if provided. In 'offline' mode GitLab is not queried and the merge
+    requests are taken from the cache.
+
+    'fetch' tells how to update the merge request refs from the origin remote
+    (see find_merge_request_iids).
+    """
     project_fullname = find_project_fullname(repo)
-    project = server.projects.get(project_fullname)
-    git_mrs = find_merge_requests_git(project, repo, since)
-    gitlab_mrs = find_merge_requests_milestone(project, milestone)
+    if offline:
+        git_mrs, gitlab_mrs = find_merge_requests_cache(
+            cache, project_fullname, repo, since, milestone
+        )
+    elif fetcher:
+        project = fetcher.call(server.projects.get, project_fullname)
+        # the milestone query runs while we look at the git history
+        gitlab_mrs = fetcher.spawn(
+            find_merge_requests_milestone, project, milestone, fetcher
+        )
+        git_mrs = find_merge_requests_git(
+            project, repo, since, fetcher=fetcher, fetch=fetch
+        )
+        gitlab_mrs = gitlab_mrs.get()
+    else:
+        project = server.projects.get(project_fullname)
+        git_mrs = find_merge_requests_git(project, repo, since, fetch=fetch)
+        gitlab_mrs = find_merge_requests_milestone(project, milestone)
+    if cache is not None and not offline:
+        for mr in itertools.chain(git_mrs, gitlab_mrs):
+            cache.add(project_fullname, mr)
+        cache.set_milestone(project_fullname, milestone, [mr.iid for mr in gitlab_mrs])
     logging.debug("Found these MRs in git history: {}".format(git_mrs))
     logging.debug("Found these MRs in GitLab: {}".format(gitlab_mrs))
 
@@ -288,6 +726,59 @@ def find_merge_requests(server, repo, since, milestone):
     return git_mrs
 
 
+class StackScheduler(object):
+    """
+    Find the merge requests of several projects of a stack concurrently.
+
+    'projects' is a list of (repo, since, milestone), processed in parallel
+    (at most 'jobs' at a time) as soon as the scheduler is created. The GitLab
+    queries are limited by the GitLabFetcher (if any), which is shared by all
+    the projects. get() returns the merge requests of all the projects, in
+    the order of 'projects'.
+    """
+
+    def __init__(
+        self,
+        projects,
+        server,
+        fetcher=None,
+        cache=None,
+        offline=False,
+        fetch=True,
+        jobs=1,
+    ):
+        from multiprocessing.pool import ThreadPool
+
+        def process(project):
+            repo, since, milestone = project
+            try:
+                return find_merge_requests(
+                    server,
+                    repo,
+                    since,
+                    milestone,
+                    fetcher=fetcher,
+                    cache=cache,
+                    offline=offline,
+                    fetch=fetch,
+                )
+            except SystemExit as err:
+                # do not let the exit kill the worker thread
+                raise RuntimeError(
+                    "failed to find merge requests for {} ({})".format(repo, err)
+                )
+
+        self._pool = ThreadPool(max(1, min(jobs, len(projects))))
+        self._results = self._pool.map_async(process, projects)
+
+    def get(self):
+        return list(itertools.chain.from_iterable(self._results.get()))
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+
 def find_dependencies(stack_config, project_name):
     all_deps = OrderedDict()
     remaining = [project_name]
@@ -296,7 +787,7 @@ def find_dependencies(stack_config, project_name):
             *(stack_config.get(name, (None, None, []))[2] for name in remaining)
         )
         remaining = []
-        for d in dependencies:
+        for d in sorted(dependencies):
             assert d not in all_deps, "circular dependency detected"
             all_deps[d] = stack_config[d]
             remaining.append(d)
@@ -375,6 +866,8 @@ def get_template(template, template_paths):
     def mr_ref(mr, relative_to=""):
         return rel_project_path(mr.fullname, relative_to) + mr.reference
 
+    from jinja2 import Environment, FileSystemLoader
+
     env = Environment(
         autoescape=False,
         loader=FileSystemLoader(template_paths),
@@ -393,6 +886,8 @@ def get_template(template, template_paths):
 
 
 def main(args=None):
+    from LbDevTools.GitTools.common import add_version_argument
+
     parser = argparse.ArgumentParser(
         description="Generate release notes draft.",
         epilog="""
@@ -411,9 +906,7 @@ Example:
 """,
         formatter_class=argparse.RawDescriptionHelpFormatter,
     )
-    parser.add_argument(
-        "--version", action="version", version="%(prog)s {}".format(__version__)
-    )
+    add_version_argument(parser)
     parser.add_argument("previous", nargs="?", help="Previous (base) release")
     parser.add_argument("target", nargs="?", help="Target release")
     parser.add_argument("-s", "--stack", help="Path to json defining stack versions")
@@ -434,7 +927,36 @@ Example:
     parser.add_argument(
         "--token", help="GitLab access token (defaults to $GITLAB_TOKEN)"
     )
+    parser.add_argument(
+        "--gitlab-url",
+        default=GITLAB_URL,
+        help="URL of the GitLab server (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=GITLAB_JOBS,
+        help="maximum number of concurrent GitLab queries (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="do not query GitLab, but use the merge requests recorded in the "
+        "cache by previous invocations",
+    )
+    parser.add_argument(
+        "--cache-file",
+        help="location of the cache of merge requests (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--narrow-fetch",
+        action="store_true",
+        help="fetch only the refs of the merge requests mentioned in the "
+        "merge commits (and not already fetched), instead of all of them",
+    )
     parser.add_argument("--debug", action="store_true", help="Increase verbosity")
+    parser.set_defaults(cache_file=get_merge_request_cache_path())
     args = parser.parse_args(args)
 
     if args.debug:
@@ -473,7 +995,7 @@ Example:
     if os.path.exists(args.output):
         logging.error("Output {} exists, aborting...".format(args.output))
         sys.exit(1)
-    if not args.token:
+    if not args.token and not args.offline:
         try:
             args.token = os.environ["GITLAB_TOKEN"]
         except KeyError:
@@ -486,22 +1008,38 @@ Example:
     template = get_template(args.template, template_paths)
     print("Using template {}".format(template.filename))
 
-    server = gitlab.Gitlab("https://gitlab.cern.ch/", args.token)
-    mrs = find_merge_requests(server, args.repo, args.previous, args.target)
+    cache = MergeRequestCache(args.cache_file)
+    if args.offline:
+        server = fetcher = None
+    else:
+        server = get_gitlab_server(args.gitlab_url, args.token, args.jobs)
+        fetcher = GitLabFetcher(args.jobs)
+    fetch = "narrow" if args.narrow_fetch else True
+    # the dependencies are processed only if the template asks for them
+    dep_mrs = []
 
     def get_dep_mrs():
-        dep_mrs = []
-        for name, (previous, target, _) in dependencies.items():
-            if target and previous and target != previous:
-                dep_mrs.extend(
-                    find_merge_requests(
-                        server,
-                        repo=os.path.join(os.path.dirname(args.stack), name),
-                        since=previous,
-                        milestone=target,
-                    )
+        if not dep_mrs:
+            dep_mrs.append(
+                StackScheduler(
+                    [
+                        (
+                            os.path.join(os.path.dirname(args.stack), name),
+                            previous,
+                            target,
+                        )
+                        for name, (previous, target, _) in dependencies.items()
+                        if target and previous and target != previous
+                    ],
+                    server,
+                    fetcher=fetcher,
+                    cache=cache,
+                    offline=args.offline,
+                    fetch=fetch,
+                    jobs=args.jobs,
                 )
-        return dep_mrs
+            )
+        return dep_mrs[0].get()
 
     project_deps = []
     for name, (_, ver, _) in dependencies.items():
@@ -524,16 +1062,37 @@ Example:
                 )
             )
 
-    context = {
-        "project": project_name,
-        "project_fullname": project_fullname,
-        "project_deps": project_deps,
-        "project_prev_tag": args.previous,
-        "version": args.target,
-        "date": datetime.date.today(),
-        "merge_requests": mrs,
-        "get_dep_mrs": get_dep_mrs,
-    }
-    with open(args.output, "w") as f:
-        f.write(template.render(context))
+    try:
+        mrs = find_merge_requests(
+            server,
+            args.repo,
+            args.previous,
+            args.target,
+            fetcher=fetcher,
+            cache=cache,
+            offline=args.offline,
+            fetch=fetch,
+        )
+
+        context = {
+            "project": project_name,
+            "project_fullname": project_fullname,
+            "project_deps": project_deps,
+            "project_prev_tag": args.previous,
+            "version": args.target,
+            "date": datetime.date.today(),
+            "merge_requests": mrs,
+            "get_dep_mrs": get_dep_mrs,
+        }
+        with open(args.output, "w") as f:
+            f.write(template.render(context))
+    except ValueError as err:
+        logging.error(str(err))
+        sys.exit(1)
+    finally:
+        for scheduler in dep_mrs:
+            scheduler.close()
+        if fetcher:
+            fetcher.close()
+        cache.save()
     print("Release notes draft written to {}.".format(args.output))
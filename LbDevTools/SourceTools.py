@@ -21,8 +21,17 @@ import os
 import re
 from itertools import islice
 from datetime import date
+from threading import Lock
+from six.moves.socketserver import StreamRequestHandler, ThreadingMixIn
+
+try:
+    from six.moves.socketserver import UnixStreamServer
+except ImportError:  # pragma: no cover
+    UnixStreamServer = object  # not available on this platform
 
 COPYRIGHT_SIGNATURE = re.compile(r"\bcopyright\b", re.I)
+COPYRIGHT_SIGNATURE_BYTES = re.compile(COPYRIGHT_SIGNATURE.pattern.encode(), re.I)
+NON_BLANK = re.compile(br"\S")
 CHECKED_FILES = re.compile(
     r".*(\.(i?[ch](pp|xx|c)?|cc|hh|py|cuh?|C|cmake|[yx]ml|qm[ts]|dtd|xsd|ent|bat|[cz]?sh|js|jsx|css|html?)|"
     r"CMakeLists.txt|Jenkinsfile)$"
@@ -60,6 +69,22 @@ ENCODING_DECLARATION = re.compile(
 CLANG_FORMAT_VERSION = "8"
 YAPF_VERSION = "0.24.0"
 FORMATTABLE_LANGUAGES = ["c", "py"]
+# maximum number of entries in the cache of formatted files
+FORMAT_CACHE_SIZE = 100000
+
+
+def iter_batches(iterable, size):
+    """
+    Split an iterable in lists of at most 'size' elements.
+
+    >>> list(iter_batches(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+    """
+    iterable = iter(iterable)
+    batch = list(islice(iterable, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterable, size))
 
 
 def is_script(path):
@@ -101,24 +126,238 @@ def has_copyright(path):
         return any(COPYRIGHT_SIGNATURE.search(l) for l in islice(f, 100))
 
 
-def get_files(reference=None):
+def head_size(data, lines=100):
     """
-    Return iterable with the list of names of files to check.
+    Return the size of the first 'lines' lines of a bytes-like object.
+
+    >>> head_size(b"a\\nb\\nc\\n", 2)
+    4
+    >>> head_size(b"a\\nb", 5)
+    3
+    """
+    pos = 0
+    for _ in range(lines):
+        pos = data.find(b"\n", pos) + 1
+        if not pos:
+            return len(data)
+    return pos
+
+
+def blob_to_check(path, data):
+    """
+    Same as to_check, but using the content 'data' of the file instead of
+    reading it from disk.
+    """
+    return bool(CHECKED_FILES.match(path)) or data.startswith(b"#!")
+
+
+def blob_is_empty(data):
+    """
+    Same as is_empty, but using the content 'data' of the file.
+    """
+    return not NON_BLANK.search(data)
+
+
+def blob_has_copyright(data):
+    """
+    Same as has_copyright, but using the content 'data' of the file.
+    """
+    return bool(COPYRIGHT_SIGNATURE_BYTES.search(data, 0, head_size(data)))
+
+
+def scan_file(path):
+    """
+    Check if 'path' has to be checked, and if so if it is empty and if it has
+    a copyright signature, mapping the file in memory and searching the bytes
+    only once.
+
+    Return None if the file is not to be checked, or a tuple
+    (is_empty, has_copyright).
+    """
+    from mmap import mmap, ACCESS_READ
+
+    if not os.path.isfile(path):
+        return None
+    with open(path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return (True, False) if CHECKED_FILES.match(path) else None
+        data = mmap(f.fileno(), 0, access=ACCESS_READ)
+        try:
+            if not blob_to_check(path, data[:2]):
+                return None
+            return (blob_is_empty(data), blob_has_copyright(data))
+        finally:
+            data.close()
+
+
+def iter_output(cmd, separator=b"\x00", chunk_size=65536):
+    """
+    Run 'cmd' and yield the items of its output delimited by 'separator' as
+    soon as they are produced, without keeping the whole output in memory.
+
+    Raise CalledProcessError if the command fails.
+
+    >>> list(iter_output(["printf", r"a\\0bc\\0d"])) == [b"a", b"bc", b"d"]
+    True
+    """
+    from subprocess import Popen, PIPE, CalledProcessError
+
+    proc = Popen(cmd, stdout=PIPE)
+    try:
+        pending = b""
+        chunk = os.read(proc.stdout.fileno(), chunk_size)
+        while chunk:
+            items = (pending + chunk).split(separator)
+            pending = items.pop()
+            for item in items:
+                yield item
+            chunk = os.read(proc.stdout.fileno(), chunk_size)
+        if pending:
+            yield pending
+    finally:
+        proc.stdout.close()
+        retcode = proc.wait()
+    if retcode:
+        raise CalledProcessError(retcode, cmd)
+
+
+def iter_blobs(entries, select=None, chunk_size=65536):
+    """
+    Yield (path, data) for each pair (path, blob_id) in 'entries', reading all
+    the blobs with a single 'git cat-file --batch' process.
+
+    'entries' is consumed while the blobs are read, so it can be a generator.
+
+    If 'select' is specified, it is called with the path and the first two
+    bytes of each blob, and the blobs for which it returns False are skipped
+    without reading them in memory.
+    """
+    from subprocess import Popen, PIPE, CalledProcessError
+    from threading import Thread
+    from six.moves.queue import Queue
+
+    cmd = ["git", "cat-file", "--batch"]
+    proc = Popen(cmd, stdin=PIPE, stdout=PIPE)
+    # paths of the blobs requested, in order (None marks the end)
+    paths = Queue()
+
+    def feed():
+        try:
+            for path, blob_id in entries:
+                paths.put(path)
+                proc.stdin.write(blob_id.encode() + b"\n")
+                proc.stdin.flush()
+        except (IOError, OSError):
+            pass  # the process was terminated (the reader stopped early)
+        finally:
+            paths.put(None)
+            try:
+                proc.stdin.close()
+            except (IOError, OSError):
+                pass
+
+    writer = Thread(target=feed)
+    writer.daemon = True
+    writer.start()
+    try:
+        for path in iter(paths.get, None):
+            header = proc.stdout.readline().split()
+            if len(header) != 3:
+                raise CalledProcessError(proc.poll() or 1, cmd)
+            # the blob content is followed by a newline
+            size = int(header[2]) + 1
+            data = proc.stdout.read(min(2, size - 1))
+            size -= len(data)
+            if select and not select(path, data):
+                while size:
+                    chunk = proc.stdout.read(min(size, chunk_size))
+                    if not chunk:
+                        raise CalledProcessError(proc.poll() or 1, cmd)
+                    size -= len(chunk)
+                continue
+            yield path, data + proc.stdout.read(size)[:-1]
+    finally:
+        # if we stopped early, git may be blocked writing to stdout and the
+        # writer thread writing to stdin, so we must stop git before joining
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        writer.join()
+
+
+def get_index_entries(paths=None):
+    """
+    Return iterable of pairs (path, blob_id) of the regular files in the git
+    index (only those in 'paths', if specified), with paths relative to the
+    current directory.
+    """
+    if paths is None:
+        cmds = [["git", "ls-files", "--stage", "-z"]]
+    else:
+        # only ask git for the requested paths (in batches, to keep the
+        # command lines short)
+        cmds = (
+            ["git", "--literal-pathspecs", "ls-files", "--stage", "-z", "--"] + batch
+            for batch in iter_batches(sorted(paths), 1000)
+        )
+    seen = set()
+    for cmd in cmds:
+        for entry in iter_output(cmd):
+            info, path = entry.split(b"\t", 1)
+            mode, blob_id, _ = info.split()
+            path = path.decode()
+            # skip symlinks, submodules and conflicting entries already seen
+            if mode in (b"120000", b"160000") or path in seen:
+                continue
+            if paths is not None and path not in paths:
+                continue
+            seen.add(path)
+            yield path, blob_id.decode()
+
+
+def get_staged_entries():
+    """
+    Return iterable of pairs (path, blob_id) of the regular files added or
+    modified in the git index (staged for the next commit), with paths
+    relative to the current directory.
+    """
+    items = iter_output(
+        [
+            "git",
+            "diff",
+            "--cached",
+            "--raw",
+            "-z",
+            "--no-abbrev",
+            "--no-renames",
+            "--diff-filter=AM",
+            "--relative",
+        ]
+    )
+    # each entry is ":<old mode> <new mode> <old id> <new id> <status>"
+    # followed by the path
+    for info, path in zip(items, items):
+        _, mode, _, blob_id, _ = info.split()
+        # skip symlinks and submodules
+        if mode not in (b"120000", b"160000"):
+            yield path.decode(), blob_id.decode()
+
+
+def list_files(reference=None):
+    """
+    Return iterable with the list of names of files tracked by git (or
+    changed with respect to 'reference'), relative to the current directory.
     """
     from subprocess import check_output
 
     if reference is None:
-        all = (
-            path.decode()
-            for path in check_output(["git", "ls-files", "-z"])
-            .rstrip(b"\x00")
-            .split(b"\x00")
-        )
+        all = (path.decode() for path in iter_output(["git", "ls-files", "-z"]))
     else:
         prefix_len = len(check_output(["git", "rev-parse", "--show-prefix"]).strip())
         all = (
             path[prefix_len:].decode()
-            for path in check_output(
+            for path in iter_output(
                 [
                     "git",
                     "diff",
@@ -130,10 +369,98 @@ def get_files(reference=None):
                     ".",
                 ]
             )
-            .rstrip(b"\x00")
-            .split(b"\x00")
         )
-    return (path for path in all if to_check(path))
+    return all
+
+
+def get_files(reference=None):
+    """
+    Return iterable with the list of names of files to check.
+    """
+    return (path for path in list_files(reference) if to_check(path))
+
+
+def get_index_files(reference=None, staged=False, files=None):
+    """
+    Return iterable of pairs (path, data) for the files to check, using the
+    content of the files in the git index instead of the working tree.
+
+    Only the files in the list 'files' are considered, if specified, or
+    else those staged for the next commit, if 'staged' is True.
+    """
+    if files is not None:
+        entries = get_index_entries(set(files))
+    elif staged:
+        entries = get_staged_entries()
+    elif reference is not None:
+        entries = get_index_entries(set(list_files(reference)))
+    else:
+        entries = get_index_entries()
+    return iter_blobs(entries, select=blob_to_check)
+
+
+def parse_diff_line_ranges(diff):
+    """
+    Parse the output of 'git diff -U0' and return a dictionary mapping the
+    names of the files to the list of ranges of lines (first, last) added or
+    modified in the new version.
+
+    >>> parse_diff_line_ranges('''diff --git a/f.cpp b/f.cpp
+    ... --- a/f.cpp
+    ... +++ b/f.cpp
+    ... @@ -1,0 +2,3 @@ int f()
+    ... +a
+    ... @@ -10 +13 @@
+    ... @@ -20,2 +22,0 @@
+    ... ''')
+    {'f.cpp': [(2, 4), (13, 13)]}
+    """
+    ranges = {}
+    current = None
+    for line in diff.splitlines():
+        if line.startswith("+++ "):
+            current = line[4:].strip('"')
+            if current.startswith("b/"):
+                current = current[2:]
+            ranges[current] = []
+        elif line.startswith("@@ ") and current:
+            m = re.match(r"@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@", line)
+            first, count = int(m.group(1)), int(m.group(2) or 1)
+            if count:  # ignore pure deletions
+                ranges[current].append((first, first + count - 1))
+    return ranges
+
+
+def get_changed_lines(reference):
+    """
+    Return a dictionary mapping the files (relative to the current directory)
+    changed in the working tree since the common ancestor of HEAD and the
+    reference commit to the ranges of lines added or modified.
+    """
+    from subprocess import check_output
+
+    base = check_output(["git", "merge-base", reference, "HEAD"]).strip().decode()
+    return parse_diff_line_ranges(
+        check_output(
+            [
+                "git",
+                "-c",
+                "core.quotePath=false",
+                "diff",
+                "-U0",
+                "--no-color",
+                "--no-ext-diff",
+                "--no-renames",
+                "--diff-filter=MA",
+                "--relative",
+                "--src-prefix=a/",
+                "--dst-prefix=b/",
+                base,
+                "--",
+                ".",
+            ]
+        ).decode("utf-8")
+    )
 
 
 def report(filenames, inverted=False, target=None, license="GPL-3.0-only"):
@@ -282,7 +609,7 @@ def add_copyright_to_file(path, year=None, license_fn=None, add_license="GPL-3.0
         f.writelines(data)
 
 
-def call_formatter(cmd, input):
+def call_formatter(cmd, input, cwd=None):
     """
     Return the formatted version of the given file.
     """
@@ -290,13 +617,295 @@ def call_formatter(cmd, input):
     import logging
 
     logging.debug("calling %r", cmd)
-    p = Popen(cmd, stdout=PIPE, stdin=PIPE, stderr=PIPE)
+    p = Popen(cmd, stdout=PIPE, stdin=PIPE, stderr=PIPE, cwd=cwd)
     out, err = p.communicate(input)
     if p.returncode:
         raise CalledProcessError(p.returncode, cmd, err)
     return out
 
 
+def parse_replacements_xml(output):
+    r"""
+    Parse the output of 'clang-format -output-replacements-xml' on several
+    files, returning one list of replacements (offset, length, text) per file.
+
+    >>> parse_replacements_xml(
+    ...     b"<?xml version='1.0'?>\n<replacements xml:space='preserve'>\n"
+    ...     b"<replacement offset='3' length='2'> </replacement>\n"
+    ...     b"</replacements>\n"
+    ...     b"<?xml version='1.0'?>\n<replacements xml:space='preserve'>\n"
+    ...     b"<replacement offset='13' length='3'>&#10;</replacement>\n"
+    ...     b"<replacement offset='20' length='1'></replacement>\n"
+    ...     b"</replacements>\n"
+    ... ) == [[(3, 2, b" ")], [(13, 3, b"\n"), (20, 1, b"")]]
+    True
+    """
+    from xml.etree import ElementTree
+
+    return [
+        [
+            (int(r.get("offset")), int(r.get("length")), (r.text or "").encode("utf-8"))
+            for r in ElementTree.fromstring(doc).findall("replacement")
+        ]
+        for doc in re.findall(b"<replacements\\b.*?</replacements>", output, re.DOTALL)
+    ]
+
+
+def apply_replacements(data, replacements):
+    """
+    Apply a list of replacements (offset, length, text) to a bytes string.
+
+    >>> apply_replacements(
+    ...     b"int  f( ){}", [(3, 2, b" "), (7, 1, b""), (9, 0, b" ")]
+    ... ) == b"int f() {}"
+    True
+    """
+    chunks = []
+    pos = 0
+    for offset, length, text in sorted(replacements):
+        chunks.append(data[pos:offset])
+        chunks.append(text)
+        pos = offset + length
+    chunks.append(data[pos:])
+    return b"".join(chunks)
+
+
+def git_blob_id(data):
+    """
+    Return the id git would assign to a blob with the given content.
+
+    >>> git_blob_id(b"hello\\n")
+    'ce013625030ba8dba906f756967f9e9ca394464a'
+    """
+    from hashlib import sha1
+
+    return sha1("blob {}\0".format(len(data)).encode() + data).hexdigest()
+
+
+def file_id(path):
+    """
+    Return a hash of the content of a file, or None if the file does not exist.
+    """
+    from hashlib import sha1
+
+    try:
+        with open(path, "rb") as f:
+            return sha1(f.read()).hexdigest()
+    except IOError:
+        return None
+
+
+def get_format_cache_path():
+    """
+    Return the default location of the cache of formatted files: inside the
+    .git directory if we are in a git repository, in the user cache directory
+    otherwise.
+    """
+    from subprocess import Popen, PIPE
+
+    p = Popen(["git", "rev-parse", "--git-common-dir"], stdout=PIPE, stderr=PIPE)
+    out, _ = p.communicate()
+    if p.returncode == 0:
+        return os.path.join(out.strip().decode(), "lb-format-cache")
+    return os.path.join(get_user_cache_dir(), "lb-format-cache")
+
+
+def get_user_cache_dir():
+    """
+    Return the user cache directory (XDG_CACHE_HOME or ~/.cache).
+    """
+    return os.environ.get(
+        "XDG_CACHE_HOME", os.path.expanduser(os.path.join("~", ".cache"))
+    )
+
+
+def write_file_atomically(path, data):
+    """
+    Write the string 'data' to the file 'path' through a temporary file, so
+    that concurrent processes never see a partially written file.
+    """
+    from tempfile import NamedTemporaryFile
+
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with NamedTemporaryFile("w", dir=os.path.dirname(path), delete=False) as f:
+        f.write(data)
+    os.rename(f.name, path)
+
+
+class FormatCache(object):
+    """
+    Persistent record of the files known to be correctly formatted.
+
+    Entries are opaque keys (see Formatter.cache_key) associated with the time
+    they were last used, so that when the cache grows beyond max_size entries
+    the least recently used are dropped.
+    """
+
+    def __init__(self, path, max_size=FORMAT_CACHE_SIZE):
+        import time
+
+        self.path = path
+        self.max_size = max_size
+        self._now = int(time.time())
+        self._entries = {}
+        self._modified = False
+        self._lock = Lock()
+        try:
+            with open(self.path) as f:
+                for l in f:
+                    key, timestamp = l.split()
+                    self._entries[key] = int(timestamp)
+        except (IOError, ValueError):
+            pass  # missing or invalid cache file, start from scratch
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries[key] = self._now
+                self._modified = True
+                return True
+        return False
+
+    def add(self, key):
+        with self._lock:
+            self._entries[key] = self._now
+            self._modified = True
+
+    def save(self):
+        """
+        Write the cache to disk (if it changed), dropping the oldest entries.
+        """
+        import logging
+
+        if not self._modified:
+            return
+        entries = sorted(self._entries.items(), key=lambda item: -item[1])
+        entries = entries[: self.max_size]
+        try:
+            write_file_atomically(
+                self.path, "".join("{} {}\n".format(*entry) for entry in entries)
+            )
+            self._modified = False
+        except (IOError, OSError) as err:
+            logging.warning("cannot write %s: %s", self.path, err)
+
+
+class GitPatch(object):
+    """
+    Collect changes to files as blobs in the git object database and write
+    them as a patch in mbox format, computing the differences with git.
+    """
+
+    def __init__(self):
+        from subprocess import check_output
+
+        self._prefix = (
+            check_output(["git", "rev-parse", "--show-prefix"]).strip().decode()
+        )
+        self._changes = []
+
+    def __len__(self):
+        return len(self._changes)
+
+    @staticmethod
+    def _hash_object(data):
+        from subprocess import Popen, PIPE, CalledProcessError
+
+        cmd = ["git", "hash-object", "-w", "--stdin"]
+        proc = Popen(cmd, stdin=PIPE, stdout=PIPE)
+        out, _ = proc.communicate(data)
+        if proc.returncode:
+            raise CalledProcessError(proc.returncode, cmd)
+        return out.strip()
+
+    def add(self, path, input, output):
+        """
+        Record the change of the file 'path' from 'input' to 'output'.
+        """
+        if input == output:
+            return
+        mode = b"100755" if os.access(path, os.X_OK) else b"100644"
+        name = os.path.normpath(os.path.join(self._prefix, path))
+        name = name.replace(os.sep, "/").encode("utf-8")
+        self._changes.append(
+            (mode, self._hash_object(input), self._hash_object(output), name)
+        )
+
+    def _write_trees(self):
+        """
+        Return the ids of the trees containing the changed files before and
+        after the changes.
+        """
+        import shutil
+        import tempfile
+        from subprocess import Popen, PIPE, CalledProcessError, check_output
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            env = dict(os.environ, GIT_INDEX_FILE=os.path.join(tmpdir, "index"))
+            trees = []
+            for blob in (1, 2):
+                cmd = ["git", "update-index", "--add", "-z", "--index-info"]
+                proc = Popen(cmd, stdin=PIPE, env=env)
+                proc.communicate(
+                    b"".join(
+                        b"%s %s\t%s\x00" % (change[0], change[blob], change[3])
+                        for change in self._changes
+                    )
+                )
+                if proc.returncode:
+                    raise CalledProcessError(proc.returncode, cmd)
+                trees.append(
+                    check_output(["git", "write-tree"], env=env).strip().decode()
+                )
+            return trees
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def write(self, out, description):
+        """
+        Write the patch to the binary file object 'out', using 'description'
+        as body of the message.
+        """
+        from email.utils import formatdate
+        from subprocess import check_call
+
+        out.write(
+            "\n".join(
+                [
+                    "From: Gitlab CI <noreply@cern.ch>",
+                    "Date: {}".format(formatdate()),
+                    "Subject: [PATCH] Fixed formatting",
+                    "MIME-Version: 1.0",
+                    "Content-Type: text/plain; charset=utf-8",
+                    "Content-Transfer-Encoding: 8bit",
+                    "",
+                    description,
+                    "",
+                    "",
+                ]
+            ).encode("utf-8")
+        )
+        out.flush()
+        check_call(
+            [
+                "git",
+                "diff-tree",
+                "-p",
+                "--no-color",
+                "--no-ext-diff",
+                "--src-prefix=a/",
+                "--dst-prefix=b/",
+            ]
+            + self._write_trees(),
+            stdout=out,
+        )
+
+
 def get_git_root(path):
     from subprocess import Popen, PIPE
 
@@ -312,6 +921,19 @@ def get_git_root(path):
         return None
 
 
+def is_subdir(path, parent):
+    """
+    Check if 'path' is 'parent' or one of its subdirectories.
+
+    >>> is_subdir("/a/b/c", "/a/b"), is_subdir("/a/b", "/a/b")
+    (True, True)
+    >>> is_subdir("/a/bc", "/a/b"), is_subdir("/a", "/a/b")
+    (False, False)
+    """
+    rel = os.path.relpath(path, parent)
+    return rel != os.pardir and not rel.startswith(os.pardir + os.sep)
+
+
 def find_clang_format(path):
     while not os.path.isdir(path):
         path = os.path.dirname(path)
@@ -325,27 +947,61 @@ def find_clang_format(path):
             return None  # root dir reached
 
 
-_found_clang_format_dirs = []
+# map of directory to the directory containing the .clang-format file that
+# applies to it (None if there is none)
+_clang_format_style_dirs = {}
+_clang_format_style_lock = Lock()
 
 
-def ensure_clang_format_style(path):
+def ensure_clang_format_style(path, cached=True):
+    """
+    Return the directory containing the .clang-format file that applies to
+    'path', creating the default one at the top of the git repository if
+    there is none.
+
+    Each directory is resolved only once (the result is cached for the
+    directory and all the ancestors visited while looking for the file),
+    unless 'cached' is False, in which case the lookup is done again and
+    the cache updated (for long running processes).
+    """
     from logging import debug
 
     path = os.path.abspath(path)
-    global _found_clang_format_dirs
-    if not any(os.path.commonprefix([d, path]) for d in _found_clang_format_dirs):
-        base = find_clang_format(path)
-        if base:
-            debug("found .clang-format in %s", base)
-            _found_clang_format_dirs.append(base)
+    while not os.path.isdir(path):
+        path = os.path.dirname(path)
+    # the lock prevents concurrent formatting jobs from creating the same
+    # .clang-format file at the same time
+    with _clang_format_style_lock:
+        if cached and path in _clang_format_style_dirs:
+            return _clang_format_style_dirs[path]
+        visited = []
+        base = dirname = path
+        while not (cached and dirname in _clang_format_style_dirs):
+            visited.append(dirname)
+            if os.path.exists(os.path.join(dirname, ".clang-format")):
+                debug("found .clang-format in %s", dirname)
+                break
+            base, dirname = dirname, os.path.dirname(dirname)
+            if base == dirname:  # root dir reached
+                dirname = None
+                break
         else:
-            base = get_git_root(path).decode()
-            debug("found .git top dir in %s", base)
-            if base:
+            dirname = _clang_format_style_dirs[dirname]
+
+        if dirname is None:
+            root = get_git_root(path)
+            if root:
+                dirname = root.decode()
+                debug("found .git top dir in %s", dirname)
                 from LbDevTools import createClangFormat
 
-                createClangFormat(os.path.join(base, ".clang-format"))
-                _found_clang_format_dirs.append(base)
+                createClangFormat(os.path.join(dirname, ".clang-format"))
+        for visited_dir in visited:
+            # directories outside the style directory (e.g. above the top
+            # level of the repository) will be looked up again if needed
+            if dirname is None or is_subdir(visited_dir, dirname):
+                _clang_format_style_dirs[visited_dir] = dirname
+        return dirname
 
 
 def find_command(names):
@@ -362,15 +1018,73 @@ class CommandNotFound(RuntimeError):
         super(CommandNotFound, self).__init__(message)
 
 
+def get_tools_cache_path():
+    """
+    Return the location of the cache of discovered commands.
+    """
+    return os.path.join(get_user_cache_dir(), "lb-format-tools.json")
+
+
+def file_stamp(path):
+    """
+    Return a list identifying the current state of a file (inode, size and
+    modification time), or None if it does not exist.
+    """
+    try:
+        st = os.stat(path)
+    except (OSError, TypeError):
+        return None
+    return [st.st_ino, st.st_size, st.st_mtime]
+
+
+def discover_command(name, version, find, cache_path=None):
+    """
+    Return the path to the command 'name' of the required 'version', as
+    returned by the callable 'find', caching the result across invocations.
+
+    Cached entries are keyed on name, version and PATH, and are valid as long
+    as inode, size and modification time of the command do not change.
+    """
+    import json
+    import logging
+
+    cache_path = cache_path or get_tools_cache_path()
+    key = " ".join([name, version, os.environ.get("PATH", "")])
+    cache = {}
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+        entry = cache[key]
+        if file_stamp(entry["path"]) == entry["stamp"]:
+            return entry["path"]
+    except (IOError, ValueError, KeyError, TypeError):
+        pass  # missing or invalid cache (entry)
+    if not isinstance(cache, dict):
+        cache = {}
+
+    cmd = find()
+    if cmd:
+        cache[key] = {"path": cmd, "stamp": file_stamp(cmd)}
+        try:
+            write_file_atomically(cache_path, json.dumps(cache, indent=1))
+        except (IOError, OSError) as err:
+            logging.debug("cannot write %s: %s", cache_path, err)
+    return cmd
+
+
 def get_clang_format_cmd(version=CLANG_FORMAT_VERSION):
-    cmd = find_command(
-        cmd.format(version)
-        for cmd in [
-            "clang-format-{}",
-            "lcg-clang-format-{}",
-            "lcg-clang-format-{}.0",
-            "lcg-clang-format-{}.0.0",
-        ]
+    cmd = discover_command(
+        "clang-format",
+        version,
+        lambda: find_command(
+            cmd.format(version)
+            for cmd in [
+                "clang-format-{}",
+                "lcg-clang-format-{}",
+                "lcg-clang-format-{}.0",
+                "lcg-clang-format-{}.0.0",
+            ]
+        ),
     )
     if not cmd:
         raise CommandNotFound("clang-format-%s not found" % version)
@@ -378,28 +1092,172 @@ def get_clang_format_cmd(version=CLANG_FORMAT_VERSION):
 
 
 def get_yapf_format_cmd(version=YAPF_VERSION):
-    from subprocess import check_output
+    def find():
+        from subprocess import check_output
+
+        cmd = find_command(["yapf"])
+        if not cmd:
+            raise CommandNotFound("yapf not found")
+        found_version = check_output([cmd, "--version"]).split()[-1].decode()
+        if found_version != version:
+            raise CommandNotFound(
+                "wrong yapf version %s (%s required)" % (found_version, version)
+            )
+        return cmd
 
-    cmd = find_command(["yapf"])
-    if not cmd:
-        raise CommandNotFound("yapf not found")
-    found_version = check_output([cmd, "--version"]).split()[-1].decode()
-    if found_version != version:
-        raise CommandNotFound(
-            "wrong yapf version %s (%s required)" % (found_version, version)
-        )
-    return cmd
+    return discover_command("yapf", version, find)
+
+
+class YapfLibrary(object):
+    """
+    Format Python code calling the yapf module in the current process, instead
+    of starting a yapf process for each file.
+
+    The style configuration file is looked up for every file, but it is
+    parsed again only if it changed.
+    """
+
+    def __init__(self):
+        # map of configuration file to its stamp (see file_stamp), the parsed
+        # style and the string identifying it
+        self._styles = {}
+        # yapf keeps the style in a global variable, so we can only format one
+        # file at a time
+        self._lock = Lock()
+
+    def _lookup_style(self, dirname):
+        """
+        Return the yapf style used when formatting from the directory
+        'dirname' (as for the yapf command reading from stdin) and a string
+        identifying it.
+        """
+        from yapf.yapflib.file_resources import GetDefaultStyleForDir
+        from yapf.yapflib.style import CreateStyleFromConfig
+
+        config = GetDefaultStyleForDir(os.path.abspath(dirname or os.getcwd()))
+        stamp = file_stamp(config)
+        cached = self._styles.get(config)
+        if cached is None or cached[0] != stamp:
+            cached = self._styles[config] = (
+                stamp,
+                CreateStyleFromConfig(config),
+                "{}:{}".format(config, file_id(config)),
+            )
+        return cached[1:]
+
+    def style(self, dirname=None):
+        """
+        Return the yapf style used when formatting from 'dirname' (current
+        directory by default).
+        """
+        return self._lookup_style(dirname)[0]
+
+    def identity(self, dirname=None):
+        """
+        Return a string identifying the version of yapf and the style used
+        when formatting from 'dirname' (current directory by default).
+        """
+        from yapf import __version__
+
+        return "yapf {} {}".format(__version__, self._lookup_style(dirname)[1])
+
+    def __call__(self, input, cwd=None, lines=None):
+        """
+        Return the formatted version of the Python code 'input', using the
+        style for the directory 'cwd' (current directory by default), and
+        optionally formatting only the ranges of lines in 'lines'.
+
+        Errors are reported as CalledProcessError, like for the yapf command.
+        """
+        from subprocess import CalledProcessError
+        from yapf.yapflib import style, yapf_api
+
+        # this is what yapf does when reading from stdin
+        source = input.decode("utf-8").rstrip() + "\n"
+        with self._lock:
+            try:
+                style.SetGlobalStyle(self.style(cwd))
+                output, _ = yapf_api.FormatCode(source, filename="<stdin>", lines=lines)
+            except Exception as err:
+                raise CalledProcessError(1, ["yapf"], str(err).encode("utf-8"))
+        return output.encode("utf-8")
+
+
+def get_yapf_library(version=YAPF_VERSION):
+    """
+    Return a YapfLibrary instance if the yapf module can be imported and it is
+    of the requested version, None otherwise.
+    """
+    from logging import debug
+
+    try:
+        import yapf
+    except ImportError:
+        debug("cannot import yapf module")
+        return None
+    if yapf.__version__ != version:
+        debug("wrong yapf module version %s (%s required)", yapf.__version__, version)
+        return None
+    return YapfLibrary()
 
 
 class Formatter:
-    def __init__(self, clang_format_cmd, yapf_cmd):
+    def __init__(self, clang_format_cmd, yapf_cmd, yapf_library=None):
         self.clang_format_cmd = clang_format_cmd
         self.yapf_cmd = yapf_cmd
+        self.yapf_library = yapf_library
+        self._clang_format_version = None
+        self._clang_format_styles = {}
+
+    def identity(self, path, lang):
+        """
+        Return a string identifying the formatter and the style used to format
+        the file 'path', or None if it cannot be determined.
+        """
+        from subprocess import check_output
+
+        if lang == "c" and self.clang_format_cmd:
+            if self._clang_format_version is None:
+                self._clang_format_version = (
+                    check_output([self.clang_format_cmd, "--version"]).strip().decode()
+                )
+            style_dir = ensure_clang_format_style(path)
+            if style_dir is None:
+                return None
+            style_file = os.path.join(style_dir, ".clang-format")
+            stamp = file_stamp(style_file)
+            cached = self._clang_format_styles.get(style_dir)
+            if cached is None or cached[0] != stamp:
+                cached = self._clang_format_styles[style_dir] = (
+                    stamp,
+                    file_id(style_file),
+                )
+            return "{} {}".format(self._clang_format_version, cached[1])
+        elif lang == "py" and self.yapf_library:
+            return self.yapf_library.identity()
+        return None
+
+    def cache_key(self, input, path, lang, lines=None):
+        """
+        Return the key identifying the result of formatting 'input' as the
+        file 'path', possibly only in the ranges 'lines' (see FormatCache), or
+        None if the result cannot be cached.
+        """
+        from hashlib import sha1
+
+        identity = self.identity(path, lang)
+        if identity is None:
+            return None
+        # the extension of the file may change the way it is formatted
+        key = [git_blob_id(input), os.path.splitext(path)[1], identity]
+        key.extend("{}-{}".format(*l) for l in lines or [])
+        return sha1(" ".join(key).encode("utf-8")).hexdigest()
 
-    def cmd(self, path, lang):
+    def cmd(self, path, lang, lines=None):
         """
         Return the command to run to format the file 'path' for language
-        'lang'.
+        'lang', optionally restricting the formatting to the ranges of lines
+        'lines' (list of pairs (first, last), 1-based).
         """
         if lang == "c":
             assert self.clang_format_cmd, (
@@ -411,16 +1269,116 @@ class Formatter:
                 "-style=file",
                 "-fallback-style=none",
                 "-assume-filename=" + path,
-            ]
+            ] + ["-lines={}:{}".format(*l) for l in lines or []]
         elif lang == "py":
             assert self.yapf_cmd, (
                 "tried to format Python file but " "yapf is not available"
             )
-            return [self.yapf_cmd]
+            return [self.yapf_cmd] + ["--lines={}-{}".format(*l) for l in lines or []]
         else:
             assert False, "invalid language %r" % lang
 
-    def __call__(self, input, path, lang, retry=True):
+    def batch_cmd(self, paths):
+        """
+        Return the command to run to format in one go the C/C++ files 'paths',
+        producing the replacements in XML format.
+        """
+        assert self.clang_format_cmd, (
+            "tried to format C/C++ file but " "clang-format is not available"
+        )
+        for path in paths:
+            ensure_clang_format_style(path)
+        return [
+            self.clang_format_cmd,
+            "-style=file",
+            "-fallback-style=none",
+            "-output-replacements-xml",
+            "--",
+        ] + list(paths)
+
+    def format_files(self, items):
+        """
+        Apply formatting rules to several files, calling clang-format only once
+        for all the C/C++ files.
+
+        :param items: list of tuples (input, path, lang, lines), where input
+                      is the content of the file on disk and lines the
+                      optional ranges of lines to format (files with ranges of
+                      lines are not grouped)
+
+        :return: list with the modified files, or the exception raised for the
+                 files that could not be formatted
+        """
+        import logging
+        from subprocess import CalledProcessError
+
+        results = [None] * len(items)
+        batch = [
+            i
+            for i, (_, _, lang, lines) in enumerate(items)
+            if lang == "c" and lines is None
+        ]
+        if len(batch) > 1:
+            try:
+                replacements = parse_replacements_xml(
+                    call_formatter(self.batch_cmd([items[i][1] for i in batch]), b"")
+                )
+                if len(replacements) != len(batch):
+                    raise ValueError(
+                        "got replacements for %d files out of %d"
+                        % (len(replacements), len(batch))
+                    )
+                for i, reps in zip(batch, replacements):
+                    results[i] = apply_replacements(items[i][0], reps)
+            except (CalledProcessError, ValueError) as err:
+                # fall back on formatting the files one by one (we also get
+                # the retry with a different file name for free)
+                logging.debug(
+                    "batch formatting failed (%s), formatting one by one", err
+                )
+
+        for i, (input, path, lang, lines) in enumerate(items):
+            if results[i] is None:
+                try:
+                    results[i] = self(input, path, lang, lines=lines)
+                except (CalledProcessError, UnicodeDecodeError) as err:
+                    results[i] = err
+        return results
+
+    def supports(self, lang):
+        """
+        Tell if the tools needed to format the language 'lang' are available.
+        """
+        if lang == "c":
+            return bool(self.clang_format_cmd)
+        elif lang == "py":
+            return bool(self.yapf_cmd or self.yapf_library)
+        return False
+
+    def format_stream(self, input, lang, cwd=None):
+        """
+        Format the content of a stream (as in the --pipe mode of lb-format),
+        using the style for the directory 'cwd' (current directory by
+        default).
+        """
+        if lang == "py" and self.yapf_library:
+            return self.yapf_library(input, cwd)
+        if lang == "c":
+            assert self.clang_format_cmd, (
+                "tried to format C/C++ file but " "clang-format is not available"
+            )
+            # the formatting server may run for a long time, so we cannot
+            # trust the cached location of the style file
+            ensure_clang_format_style(cwd or os.getcwd(), cached=False)
+            cmd = [self.clang_format_cmd, "-style=file", "-fallback-style=none"]
+        else:
+            assert self.yapf_cmd, (
+                "tried to format Python file but " "yapf is not available"
+            )
+            cmd = [self.yapf_cmd]
+        return call_formatter(cmd, input, cwd)
+
+    def __call__(self, input, path, lang, retry=True, lines=None):
         """
         Apply formatting rules to a file.
 
@@ -430,6 +1388,7 @@ class Formatter:
         :param retry: boolean flag to tell if we have to retry the formatting
                       with a slightly modified name (see
                       https://gitlab.cern.ch/lhcb-core/LbDevTools/issues/20)
+        :param lines: optional list of ranges of lines (first, last) to format
 
         :return: modified file, exception in case of problems
         """
@@ -437,7 +1396,9 @@ class Formatter:
         from subprocess import CalledProcessError
 
         try:
-            return call_formatter(self.cmd(path, lang), input)
+            if lang == "py" and self.yapf_library:
+                return self.yapf_library(input, lines=lines)
+            return call_formatter(self.cmd(path, lang, lines), input)
 
         except CalledProcessError:
             if lang == "c" and path.endswith(".h") and retry:
@@ -446,13 +1407,295 @@ class Formatter:
                 try:
                     alias = path + "h"
                     logging.info("retry formatting of %s as %s", path, alias)
-                    return self(input, alias, lang, False)
+                    return self(input, alias, lang, False, lines)
                 except CalledProcessError:
                     # ignore failures in the retry
                     pass
             raise  # raise original exception
 
 
+def get_formatter(clang_format_version, yapf_version):
+    """
+    Return a Formatter instance for the requested versions of clang-format and
+    yapf, and the list of errors for the tools that could not be found.
+    """
+    clang_format_cmd = yapf_cmd = None
+    errors = []
+    try:
+        clang_format_cmd = get_clang_format_cmd(clang_format_version)
+    except CommandNotFound as err:
+        errors.append(err)
+    yapf_library = get_yapf_library(yapf_version)
+    if not yapf_library:
+        try:
+            yapf_cmd = get_yapf_format_cmd(yapf_version)
+        except CommandNotFound as err:
+            errors.append(err)
+    return Formatter(clang_format_cmd, yapf_cmd, yapf_library), errors
+
+
+def default_server_socket():
+    """
+    Return the default path of the socket of the lb-format server, in the
+    user runtime directory or in a private directory in the temporary
+    directory.
+    """
+    from tempfile import gettempdir
+
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        return os.path.join(os.environ["XDG_RUNTIME_DIR"], "lb-format.sock")
+    return os.path.join(
+        gettempdir(), "lb-format-{}".format(os.getuid()), "lb-format.sock"
+    )
+
+
+class FormatServerError(RuntimeError):
+    pass
+
+
+def is_own_socket(path):
+    """
+    Tell if 'path' is a Unix socket owned by the current user.
+    """
+    import stat
+
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid()
+
+
+def ensure_socket_dir(path):
+    """
+    Create (with mode 0700) the directory for the server socket 'path' if
+    needed, and check that only the current user can create files in it.
+    """
+    import errno
+    import stat
+
+    dirname = os.path.dirname(os.path.abspath(path))
+    try:
+        os.mkdir(dirname, 0o700)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+    st = os.lstat(dirname)
+    if (
+        not stat.S_ISDIR(st.st_mode)
+        or st.st_uid != os.getuid()
+        or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+    ):
+        raise FormatServerError(
+            "refusing to use {}: not a directory writable only by the "
+            "current user".format(dirname)
+        )
+
+
+class _FormatRequestHandler(StreamRequestHandler):
+    """
+    Handle a formatting request.
+
+    The request is a line with a JSON object (fields 'lang', 'cwd',
+    'clang_format_version' and 'yapf_version') followed by the content to
+    format.  The reply is a line with a JSON object (fields 'status' and,
+    in case of failure, 'error') followed by the formatted content.
+    """
+
+    def handle(self):
+        import json
+        import logging
+        from subprocess import CalledProcessError
+
+        output = b""
+        try:
+            request = json.loads(self.rfile.readline().decode("utf-8"))
+            input = self.rfile.read()
+            logging.debug("request %r (%d bytes)", request, len(input))
+            formatter = self.server.formatter(
+                request["clang_format_version"], request["yapf_version"]
+            )
+            if not formatter.supports(request["lang"]):
+                raise CommandNotFound(
+                    "{} formatting not available".format(
+                        "C/C++" if request["lang"] == "c" else "Python"
+                    )
+                )
+            output = formatter.format_stream(input, request["lang"], request["cwd"])
+            reply = {"status": 0}
+        except CalledProcessError as err:
+            reply = {
+                "status": err.returncode,
+                "error": "{}\n{}".format(err, err.output.decode("utf-8", "replace")),
+            }
+        except Exception as err:
+            reply = {"status": 1, "error": "{}: {}".format(type(err).__name__, err)}
+        self.wfile.write(json.dumps(reply).encode("utf-8") + b"\n")
+        self.wfile.write(output)
+
+
+class FormatServer(ThreadingMixIn, UnixStreamServer):
+    """
+    Server to format code for the --pipe mode of lb-format, keeping tool
+    discovery, style resolution and the yapf module alive between requests.
+
+    The server terminates if it does not receive requests for 'timeout'
+    seconds.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, timeout=None):
+        UnixStreamServer.__init__(self, path, _FormatRequestHandler)
+        os.chmod(path, 0o600)
+        self.timeout = timeout
+        self.expired = False
+        self._formatters = {}
+        self._lock = Lock()
+
+    def formatter(self, clang_format_version, yapf_version):
+        """
+        Return the (cached) Formatter for the requested tool versions.
+        """
+        key = (clang_format_version, yapf_version)
+        with self._lock:
+            if key not in self._formatters:
+                self._formatters[key] = get_formatter(*key)[0]
+            return self._formatters[key]
+
+    def handle_timeout(self):
+        self.expired = True
+
+    def serve_until_idle(self):
+        """
+        Handle requests until no request arrives for 'timeout' seconds.
+        """
+        try:
+            while not self.expired:
+                self.handle_request()
+        finally:
+            self.server_close()
+            os.remove(self.server_address)
+
+
+def serve_formatting(path, timeout=None):
+    """
+    Run a formatting server listening on the Unix socket 'path', unless
+    another server is already listening on it.
+    """
+    import logging
+    import socket
+
+    ensure_socket_dir(path)
+    if os.path.lexists(path):
+        if not is_own_socket(path):
+            raise FormatServerError(
+                "refusing to replace {}: not a socket owned by the current "
+                "user".format(path)
+            )
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            logging.info("server already running on %s", path)
+            return
+        except socket.error:
+            os.remove(path)  # stale socket
+        finally:
+            probe.close()
+    server = FormatServer(path, timeout)
+    logging.info("serving on %s", path)
+    server.serve_until_idle()
+
+
+def format_with_server(path, input, lang, versions, start=True, wait=5):
+    """
+    Format 'input' using the server listening on the Unix socket 'path',
+    starting it if needed (and 'start' is True).
+
+    :param versions: tuple with the required versions of clang-format and yapf
+
+    :return: the formatted content or None if the server is not available
+             (sockets not owned by the current user are never used)
+    """
+    import json
+    import logging
+    import socket
+    import sys
+    import time
+    from subprocess import Popen
+
+    def connect():
+        # never send the sources to a server started by somebody else
+        if not is_own_socket(path):
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            return sock
+        except socket.error:
+            sock.close()
+            return None
+
+    sock = connect()
+    if not sock and os.path.lexists(path) and not is_own_socket(path):
+        logging.warning("ignoring %s: not a socket owned by the current user", path)
+        return None
+    if not sock and start:
+        try:
+            ensure_socket_dir(path)
+        except (OSError, FormatServerError) as err:
+            logging.warning("cannot start server: %s", err)
+            return None
+        logging.debug("starting server on %s", path)
+        with open(os.devnull, "r+b") as devnull:
+            Popen(
+                [
+                    sys.executable,
+                    "-c",
+                    "from LbDevTools.SourceTools import format; format()",
+                    "--serve",
+                    "--server-socket",
+                    path,
+                ],
+                stdin=devnull,
+                stdout=devnull,
+                stderr=devnull,
+                close_fds=True,
+                preexec_fn=os.setsid,
+            )
+        deadline = time.time() + wait
+        while not sock and time.time() < deadline:
+            time.sleep(0.02)
+            sock = connect()
+    if not sock:
+        logging.debug("cannot connect to server on %s", path)
+        return None
+
+    try:
+        request = {
+            "lang": lang,
+            "cwd": os.getcwd(),
+            "clang_format_version": versions[0],
+            "yapf_version": versions[1],
+        }
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        sock.sendall(input)
+        sock.shutdown(socket.SHUT_WR)
+        data = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data.append(chunk)
+    finally:
+        sock.close()
+    reply, output = b"".join(data).split(b"\n", 1)
+    reply = json.loads(reply.decode("utf-8"))
+    if reply["status"]:
+        raise FormatServerError(reply["error"])
+    return output
+
+
 # --- Scripts
 
 
@@ -470,6 +1713,12 @@ def check_copyright():
         nargs="?",
         help="commit-ish to use as reference to only check changed file",
     )
+    parser.add_argument(
+        "files",
+        nargs="*",
+        help="with --staged, files to check instead of all the staged ones "
+        "(the reference argument is then taken as the first file)",
+    )
     parser.add_argument(
         "--porcelain",
         action="store_true",
@@ -501,21 +1750,77 @@ def check_copyright():
         type=re.compile,
         help="Regex of filenames that should be ignored",
     )
-    parser.set_defaults(inverted=False, separator="\n")
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        help="check the content of the files in the git index instead of the "
+        "working tree (read in one pass from the git object store)",
+    )
+    parser.add_argument(
+        "--staged",
+        action="store_true",
+        help="only check the files staged for the next commit (or the files "
+        "on the command line), as they are in the git index (implies --index)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="number of files to scan in parallel in the working tree "
+        "(default: %(default)s)",
+    )
+    parser.set_defaults(inverted=False, separator="\n", jobs=1)
 
     args = parser.parse_args()
 
-    missing = [
-        path
-        for path in get_files(args.reference)
-        # we only deal with non-empty files and we report as "missing"
-        # those without copyright, unless `args.inverted` is True, in which
-        # case we invert the answer of has_copyright, to report the file _with_
-        # copyright notice
-        if not is_empty(path)
-        and not (args.inverted ^ has_copyright(path))
-        and not any(pattern.search(path) for pattern in args.exclude)
-    ]
+    if args.staged:
+        # the positional arguments are all files (as passed by pre-commit)
+        if args.reference:
+            args.files.insert(0, args.reference)
+            args.reference = None
+    elif args.files:
+        parser.error("files can be specified only with --staged")
+
+    if args.index or args.staged:
+        missing = [
+            path
+            for path, data in get_index_files(
+                args.reference, args.staged, args.files or None
+            )
+            if not blob_is_empty(data)
+            and not (args.inverted ^ blob_has_copyright(data))
+            and not any(pattern.search(path) for pattern in args.exclude)
+        ]
+    elif args.jobs > 1:
+        from multiprocessing.pool import ThreadPool
+
+        paths = (
+            path
+            for path in list_files(args.reference)
+            if not any(pattern.search(path) for pattern in args.exclude)
+        )
+        pool = ThreadPool(args.jobs)
+        # scan results come back in the order of the paths
+        scans = pool.imap(lambda path: (path, scan_file(path)), paths, chunksize=64)
+        missing = [
+            path
+            for path, scan in scans
+            if scan and not scan[0] and not (args.inverted ^ scan[1])
+        ]
+        pool.close()
+        pool.join()
+    else:
+        missing = [
+            path
+            for path in get_files(args.reference)
+            # we only deal with non-empty files and we report as "missing"
+            # those without copyright, unless `args.inverted` is True, in
+            # which case we invert the answer of has_copyright, to report the
+            # file _with_ copyright notice
+            if not is_empty(path)
+            and not (args.inverted ^ has_copyright(path))
+            and not any(pattern.search(path) for pattern in args.exclude)
+        ]
     if missing:
         missing.sort()
         if not args.porcelain:
@@ -531,7 +1836,7 @@ def add_copyright():
     parser = ArgumentParser(
         description="Add standard LHCb copyright statement to files."
     )
-    parser.add_argument("files", nargs="+", help="files to modify")
+    parser.add_argument("files", nargs="*", help="files to modify")
     parser.add_argument(
         "--year", help="copyright year specification (default: current year)"
     )
@@ -554,9 +1859,30 @@ def add_copyright():
         action="store_true",
         help="Print modified files but don't print warnings (for pre-commit hook)",
     )
+    parser.add_argument(
+        "--staged",
+        action="store_true",
+        help="look for the copyright statement in the content of the files "
+        "in the git index (by default all the files staged for the next commit)",
+    )
 
     args = parser.parse_args()
 
+    # content of the files in the git index, if requested
+    staged = {}
+    if args.staged:
+        staged = dict(
+            iter_blobs(
+                get_index_entries(set(args.files))
+                if args.files
+                else get_staged_entries()
+            )
+        )
+        if not args.files:
+            args.files = sorted(staged)
+    elif not args.files:
+        parser.error("no file to modify")
+
     for path in args.files:
         if not args.force and not to_check(path):
             if not args.pre_commit:
@@ -564,7 +1890,9 @@ def add_copyright():
                     "warning: cannot add copyright to {} (file type not "
                     "supported)".format(path)
                 )
-        elif has_copyright(path):
+        elif (
+            blob_has_copyright(staged[path]) if path in staged else has_copyright(path)
+        ):
             if not args.pre_commit:
                 print("warning: {} already has a copyright statement".format(path))
         else:
@@ -575,6 +1903,7 @@ def add_copyright():
 
 def format():
     from argparse import ArgumentParser
+    from multiprocessing import cpu_count
     import logging
 
     parser = ArgumentParser(description="Reformat C++ and Python files.")
@@ -613,12 +1942,26 @@ def format():
         help="check/format only the files select the files that have changed "
         "since the REFERENCE commit/branch",
     )
+    parser.add_argument(
+        "--lines-from-diff",
+        action="store_true",
+        help="format only the lines changed in the working tree since the "
+        "REFERENCE commit/branch, uncommitted changes included (requires "
+        "--reference or --format-patch)",
+    )
     parser.add_argument(
         "--format-patch",
         help="create a patch file with the changes, "
         "in this mode the first file argument is interpreted "
         "as argument to the --reference option",
     )
+    parser.add_argument(
+        "--patch-backend",
+        choices=["difflib", "git"],
+        help="how to compute the differences for --format-patch: in memory "
+        "with Python difflib, or streamed to the patch file by git using "
+        "blobs written to the git object database (default: %(default)s)",
+    )
     parser.add_argument(
         "-P",
         "--pipe",
@@ -626,11 +1969,63 @@ def format():
         choices=FORMATTABLE_LANGUAGES,
         help="format from stdin to stdout (allowed values: %s)" % FORMATTABLE_LANGUAGES,
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="number of files to format in parallel (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        help="maximum number of C/C++ files to pass to one clang-format "
+        "process (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--server",
+        action="store_true",
+        help="in --pipe mode, delegate the formatting to a long-lived server "
+        "(started if needed), enabled by default if LB_FORMAT_SERVER is set",
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="run a formatting server for the --pipe mode, which terminates "
+        "after --server-timeout seconds without requests",
+    )
+    parser.add_argument(
+        "--server-socket",
+        help="Unix socket used by the formatting server (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--server-timeout",
+        type=float,
+        help="idle time (in seconds) after which the server terminates "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_false",
+        dest="use_cache",
+        help="do not use the cache of files known to be correctly formatted",
+    )
+    parser.add_argument(
+        "--cache-file",
+        help="location of the cache of files known to be correctly formatted "
+        "(default: lb-format-cache in the .git directory)",
+    )
     parser.set_defaults(
         files=[],
         clang_format_version=CLANG_FORMAT_VERSION,
         yapf_version=YAPF_VERSION,
         log_level=logging.WARNING,
+        jobs=cpu_count(),
+        batch_size=16,
+        use_cache=True,
+        server=bool(os.environ.get("LB_FORMAT_SERVER")),
+        server_socket=default_server_socket(),
+        server_timeout=600,
+        patch_backend="difflib",
     )
 
     args = parser.parse_args()
@@ -647,6 +2042,11 @@ def format():
     if args.reference and args.files:
         parser.error("you cannot specify files with --reference")
 
+    if args.jobs < 1:
+        parser.error("invalid number of jobs: %d" % args.jobs)
+    if args.batch_size < 1:
+        parser.error("invalid batch size: %d" % args.batch_size)
+
     if args.format_patch:
         if len(args.files) > 1:
             parser.error(
@@ -656,12 +2056,48 @@ def format():
         elif args.files:
             args.reference = args.files.pop()
 
+    if args.lines_from_diff and not args.reference:
+        parser.error("--lines-from-diff requires a reference commit")
+
+    if args.serve:
+        if args.pipe or args.files or args.reference or args.format_patch:
+            parser.error("--serve cannot be used with other modes")
+        import sys
+
+        try:
+            serve_formatting(args.server_socket, args.server_timeout)
+        except FormatServerError as err:
+            exit("%s: %s" % (os.path.basename(sys.argv[0]), err))
+        return
+
+    if args.pipe:
+        import sys
+
+        # stdin and stdout have to be used in binary mode
+        pipe_input = getattr(sys.stdin, "buffer", sys.stdin).read()
+        pipe_output = getattr(sys.stdout, "buffer", sys.stdout)
+        if args.server:
+            try:
+                output = format_with_server(
+                    args.server_socket,
+                    pipe_input,
+                    args.pipe,
+                    (args.clang_format_version, args.yapf_version),
+                )
+            except FormatServerError as err:
+                exit("%s: %s" % (os.path.basename(sys.argv[0]), err))
+            if output is not None:
+                pipe_output.write(output)
+                return
+            logging.warning("formatting server not available, formatting locally")
+
     from logging import debug, warning, info, error
     from subprocess import CalledProcessError
     from difflib import unified_diff
+    from itertools import chain
 
     # look for the required commands
-    clang_format_cmd = yapf_cmd = None
+    clang_format_cmd = yapf_cmd = yapf_library = None
     try:
         clang_format_cmd = get_clang_format_cmd(args.clang_format_version)
         info("using clang-format: %s", clang_format_cmd)
@@ -670,50 +2106,126 @@ def format():
             "%s: C/C++ formatting not available" % err
         )
 
-    try:
-        yapf_cmd = get_yapf_format_cmd(args.yapf_version)
-        info("using yapf: %s", yapf_cmd)
-    except CommandNotFound as err:
-        (parser.error if args.pipe == "py" else warning)(
-            "%s: Python formatting not available" % err
-        )
+    yapf_library = get_yapf_library(args.yapf_version)
+    if yapf_library:
+        info("using yapf module")
+    else:
+        # fall back on the yapf command
+        try:
+            yapf_cmd = get_yapf_format_cmd(args.yapf_version)
+            info("using yapf: %s", yapf_cmd)
+        except CommandNotFound as err:
+            (parser.error if args.pipe == "py" else warning)(
+                "%s: Python formatting not available" % err
+            )
+
+    formatter = Formatter(clang_format_cmd, yapf_cmd, yapf_library)
 
     def can_format(path):
         if to_check(path):
             lang = lang_family(path)
-            if (clang_format_cmd and lang == "c") or (yapf_cmd and lang == "py"):
+            if formatter.supports(lang):
                 return lang
         return None
 
+    changed_lines = None
+    if args.lines_from_diff:
+        changed_lines = get_changed_lines(args.reference)
+
     if not args.pipe:
-        if not args.files:
+        if changed_lines is not None:
+            # the files and the lines to format come from the same diff
+            args.files = (f for f in sorted(changed_lines) if can_format(f))
+        elif not args.files:
             args.files = (f for f in get_files(args.reference) if can_format(f))
 
-    if args.pipe:
-        import sys
-
-        if args.pipe == "c":
-            ensure_clang_format_style(os.getcwd())
-            cmd = [clang_format_cmd, "-style=file", "-fallback-style=none"]
-        else:
-            cmd = [yapf_cmd]
-        debug("cmd %s", cmd)
-        print(call_formatter(cmd, sys.stdin.read()), end="")
     patch = []
     encoding_errors = []
-    formatter = Formatter(clang_format_cmd, yapf_cmd)
-    for path in args.files:
-        lang = can_format(path)
+    if args.format_patch and args.patch_backend == "git":
+        patch = GitPatch()
+
+    if args.pipe:
+        pipe_output.write(formatter.format_stream(pipe_input, args.pipe))
+
+    cache = None
+    if args.use_cache and not args.pipe:
+        cache = FormatCache(args.cache_file or get_format_cache_path())
+        debug("using cache %s (%d entries)", cache.path, len(cache))
+
+    def format_files(paths):
+        """
+        Format a batch of files, returning a list of tuples
+        (path, lang, input, output, exc), where exc is the exception raised
+        while formatting (if any).
+        """
+        results = []
+        to_format = []
+        keys = {}
+        for path in paths:
+            lang = can_format(path)
+            input = output = exc = None
+            if lang:
+                try:
+                    with open(path, "rb") as f:
+                        input = f.read()
+                    lines = changed_lines.get(path) if changed_lines else None
+                    if is_empty(path):
+                        # make sure virtually empty files are empty
+                        output = b""
+                    elif changed_lines is not None and not lines:
+                        # nothing to format in this file
+                        output = input
+                    else:
+                        key = cache is not None and formatter.cache_key(
+                            input, path, lang, lines
+                        )
+                        if key and key in cache:
+                            debug("%s already formatted", path)
+                            output = input
+                        else:
+                            keys[len(results)] = key
+                            to_format.append((len(results), lines))
+                except UnicodeDecodeError as err:
+                    exc = err
+            results.append([path, lang, input, output, exc])
+
+        outputs = formatter.format_files(
+            [
+                (results[i][2], results[i][0], results[i][1], lines)
+                for i, lines in to_format
+            ]
+        )
+        for (i, _), output in zip(to_format, outputs):
+            results[i][4 if isinstance(output, Exception) else 3] = output
+            if keys[i] and output == results[i][2]:
+                cache.add(keys[i])
+        return results
+
+    # the files are formatted in parallel (in batches), but the results are
+    # processed in the order of the input list, so that the report and the
+    # patch are stable
+    batches = iter_batches(args.files, args.batch_size)
+    pool = None
+    if args.jobs > 1:
+        from multiprocessing.pool import ThreadPool
+
+        pool = ThreadPool(args.jobs)
+        results = pool.imap(format_files, batches)
+    else:
+        results = (format_files(batch) for batch in batches)
+    results = chain.from_iterable(results)
+
+    for path, lang, input, output, exc in results:
         if lang:
             try:
-                with open(path, "rb") as f:
-                    input = f.read()
-                if is_empty(path):
-                    # make sure virtually empty files are empty
-                    output = b""
-                else:
-                    output = formatter(input, path, lang)
-                if args.format_patch:
+                if exc:
+                    raise exc
+                if isinstance(patch, GitPatch):
+                    # make sure we report the same encoding errors as difflib
+                    input.decode("utf-8")
+                    output.decode("utf-8")
+                    patch.add(path, input, output)
+                elif args.format_patch:
                     patch.extend(
                         l
                         if l.endswith("\n")
@@ -740,6 +2252,13 @@ def format():
         else:
             warning("cannot format %s (file type not supported)", path)
 
+    if pool:
+        pool.close()
+        pool.join()
+
+    if cache is not None:
+        cache.save()
+
     # report encoding errors
     if encoding_errors:
         print(
@@ -756,39 +2275,44 @@ def format():
         from email.message import Message
         from email.utils import formatdate
 
-        msg = Message()
-        msg.add_header("From", "Gitlab CI <noreply@cern.ch>")
-        msg.add_header("Date", formatdate())
-        msg.add_header("Subject", "[PATCH] Fixed formatting")
-        payload = "\n".join(
-            [
-                "patch generated by {}".format(
-                    "{CI_PROJECT_URL}/-/jobs/{CI_JOB_ID}".format(**os.environ)
-                    if "CI" in os.environ
-                    else "standalone job"
-                ),
-                "",
-                "",
-                "".join(patch),
-            ]
+        description = "patch generated by {}".format(
+            "{CI_PROJECT_URL}/-/jobs/{CI_JOB_ID}".format(**os.environ)
+            if "CI" in os.environ
+            else "standalone job"
         )
-        try:
-            payload.encode("ascii")
-        except UnicodeEncodeError:
-            charset = "utf-8"
-        else:
-            charset = None
-        msg.set_payload(payload, charset=charset)
+        msg = None
+        if not isinstance(patch, GitPatch):
+            msg = Message()
+            msg.add_header("From", "Gitlab CI <noreply@cern.ch>")
+            msg.add_header("Date", formatdate())
+            msg.add_header("Subject", "[PATCH] Fixed formatting")
+            payload = "\n".join([description, "", "", "".join(patch)])
+            try:
+                payload.encode("ascii")
+            except UnicodeEncodeError:
+                charset = "utf-8"
+            else:
+                charset = None
+            msg.set_payload(payload, charset=charset)
 
         if args.format_patch == "-":
-            print(msg)
+            if msg:
+                print(msg)
+            else:
+                import sys
+
+                sys.stdout.flush()
+                patch.write(getattr(sys.stdout, "buffer", sys.stdout), description)
         else:
             if os.path.dirname(args.format_patch) and not os.path.isdir(
                 os.path.dirname(args.format_patch)
             ):
                 os.makedirs(os.path.dirname(args.format_patch))
             with open(args.format_patch, "wb") as patchfile:
-                patchfile.write(bytes(msg))
+                if msg:
+                    patchfile.write(bytes(msg))
+                else:
+                    patch.write(patchfile, description)
             print(
                 "=======================================",
                 " You can fix formatting with:",
@@ -13,15 +13,45 @@ from __future__ import print_function
 
 from __future__ import absolute_import
 import os
+import sys
 
-from pkg_resources import get_distribution, DistributionNotFound
 import six
 
-try:
-    __version__ = get_distribution(__name__).version
-except DistributionNotFound:  # pragma: no cover
-    # package is not installed
-    __version__ = "unknown"
+
+def _get_version():
+    """
+    Return the version of the installed package ("unknown" if not installed).
+    """
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+    except ImportError:  # Python < 3.8
+        from pkg_resources import get_distribution, DistributionNotFound
+
+        try:
+            return get_distribution(__name__).version
+        except DistributionNotFound:  # pragma: no cover
+            return "unknown"
+    try:
+        return version(__name__)
+    except PackageNotFoundError:  # pragma: no cover
+        # package is not installed
+        return "unknown"
+
+
+if sys.version_info >= (3, 7):
+
+    def __getattr__(name):
+        # __version__ is computed only when needed, as looking up the package
+        # metadata is slow (and not needed by most commands)
+        if name == "__version__":
+            global __version__
+            __version__ = _get_version()
+            return __version__
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+else:  # pragma: no cover
+    __version__ = _get_version()
 
 DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
 
@@ -39,3 +39,103 @@ def test_to_check():
 def test_has_copyright():
     assert C.has_copyright(splitext(__file__)[0] + ".py")
     assert not C.has_copyright(join(DATA_DIR, "a_script"))
+
+
+def test_blob_checks():
+    assert C.blob_to_check("source.cpp", b"")
+    assert C.blob_to_check("a_script", b"#!/bin/sh\n")
+    assert not C.blob_to_check("not_a_script", b"some text\n")
+    assert C.blob_is_empty(b"  \n\n")
+    assert not C.blob_is_empty(b"x\n")
+    assert C.blob_has_copyright(b"# (c) Copyright 2021 CERN\n")
+    assert not C.blob_has_copyright(b"\n" * 100 + b"# (c) Copyright 2021 CERN\n")
+
+
+def test_index_files():
+    import os
+    import shutil
+    import tempfile
+    from subprocess import check_call
+
+    tmpdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        os.chdir(tmpdir)
+        check_call(["git", "init", "-q", "."])
+        for name, content in (
+            ("with.py", "# (c) Copyright 2021 CERN\n"),
+            ("without.cpp", "int f();\n"),
+            ("empty.h", "  \n"),
+            ("a_script", "#!/bin/sh\n"),
+            ("not_a_script", "text\n"),
+            ("data.bin", "x" * 200000),
+        ):
+            with open(name, "w") as f:
+                f.write(content)
+        check_call(["git", "add", "."])
+        # changes in the working tree are ignored
+        with open("without.cpp", "w") as f:
+            f.write("// (c) Copyright 2021 CERN\n")
+
+        files = dict(C.get_index_files())
+        assert sorted(files) == ["a_script", "empty.h", "with.py", "without.cpp"]
+        assert files["without.cpp"] == b"int f();\n"
+
+        check_call(
+            ["git", "-c", "user.name=A", "-c", "user.email=a@b.c"]
+            + ["commit", "-q", "-m", "initial"]
+        )
+        check_call(["git", "add", "without.cpp"])
+        staged = list(C.get_staged_entries())
+        assert [path for path, _ in staged] == ["without.cpp"]
+        assert staged[0][1] == C.git_blob_id(b"// (c) Copyright 2021 CERN\n")
+        assert list(C.get_index_files(staged=True)) == [
+            ("without.cpp", b"// (c) Copyright 2021 CERN\n")
+        ]
+        # explicit files are checked even if not staged
+        assert sorted(C.get_index_files(files=["with.py", "a_script"])) == [
+            ("a_script", b"#!/bin/sh\n"),
+            ("with.py", b"# (c) Copyright 2021 CERN\n"),
+        ]
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+
+def test_iter_blobs_early_stop():
+    import os
+    import shutil
+    import tempfile
+    from subprocess import check_call, check_output
+    from threading import Thread
+
+    tmpdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        os.chdir(tmpdir)
+        check_call(["git", "init", "-q", "."])
+        with open("big", "wb") as f:
+            f.write(b"x" * 100000)
+        blob_id = check_output(["git", "hash-object", "-w", "big"]).strip().decode()
+
+        # git fills the pipe with blobs that are never read
+        def read_one():
+            blobs = C.iter_blobs(("big", blob_id) for _ in range(20000))
+            next(blobs)
+            blobs.close()
+
+        reader = Thread(target=read_one)
+        reader.daemon = True
+        reader.start()
+        reader.join(30)
+        assert not reader.is_alive()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+
+def test_scan_file():
+    assert C.scan_file(join(DATA_DIR, "not_a_script")) is None
+    assert C.scan_file(join(DATA_DIR, "a_script")) == (False, False)
+    assert C.scan_file(splitext(__file__)[0] + ".py") == (False, True)
+    assert C.scan_file(DATA_DIR) is None
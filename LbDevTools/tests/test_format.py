@@ -0,0 +1,441 @@
+###############################################################################
+# (c) Copyright 2021 CERN for the benefit of the LHCb Collaboration           #
+#                                                                             #
+# This software is distributed under the terms of the GNU General Public      #
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".   #
+#                                                                             #
+# In applying this licence, CERN does not waive the privileges and immunities #
+# granted to it by virtue of its status as an Intergovernmental Organization  #
+# or submit itself to any jurisdiction.                                       #
+###############################################################################
+from __future__ import print_function
+
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+
+import LbDevTools.SourceTools as S
+
+
+class TestFormatCache(object):
+    @classmethod
+    def setup_class(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def test_roundtrip(self):
+        path = os.path.join(self.tmpdir, "roundtrip", "cache")
+        cache = S.FormatCache(path)
+        assert "a" not in cache
+        cache.add("a")
+        assert "a" in cache
+        cache.save()
+
+        cache = S.FormatCache(path)
+        assert len(cache) == 1
+        assert "a" in cache
+        assert "b" not in cache
+
+    def test_eviction(self):
+        path = os.path.join(self.tmpdir, "eviction", "cache")
+        cache = S.FormatCache(path, max_size=2)
+        for key, timestamp in (("old", 1), ("new", 3), ("mid", 2)):
+            cache.add(key)
+            cache._entries[key] = timestamp
+        cache.save()
+
+        cache = S.FormatCache(path)
+        assert len(cache) == 2
+        assert "old" not in cache
+        assert "mid" in cache and "new" in cache
+
+    def test_invalid_file(self):
+        path = os.path.join(self.tmpdir, "invalid", "cache")
+        os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write("garbage\n")
+        assert len(S.FormatCache(path)) == 0
+
+
+def test_format_server():
+    from threading import Thread
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "server.sock")
+        server = S.FormatServer(path)
+        versions = (S.CLANG_FORMAT_VERSION, S.YAPF_VERSION)
+        try:
+            for input, expected in (
+                (b"x=[ 1,2 ]\n", b"x = [1, 2]\n"),
+                (b"def f(:\n", None),
+            ):
+                thread = Thread(target=server.handle_request)
+                thread.start()
+                try:
+                    output = S.format_with_server(path, input, "py", versions, False)
+                except S.FormatServerError:
+                    output = None
+                thread.join()
+                assert output == expected
+        finally:
+            server.server_close()
+        # no server listening
+        assert S.format_with_server(path, b"x=1\n", "py", versions, False) is None
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_format_server_socket_owner():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "server.sock")
+        with open(path, "w") as f:
+            f.write("not a socket\n")
+        versions = (S.CLANG_FORMAT_VERSION, S.YAPF_VERSION)
+        assert S.format_with_server(path, b"x=1\n", "py", versions) is None
+        try:
+            S.serve_formatting(path)
+            assert False, "exception expected"
+        except S.FormatServerError:
+            pass
+        assert os.path.exists(path)
+
+        os.chmod(tmpdir, 0o777)
+        try:
+            S.ensure_socket_dir(path)
+            assert False, "exception expected"
+        except S.FormatServerError:
+            pass
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_yapf_style_changes():
+    library = S.get_yapf_library()
+    if not library:
+        return  # yapf module not available
+    tmpdir = tempfile.mkdtemp()
+    try:
+        input = b"def f():\n  return 1\n"
+        style = os.path.join(tmpdir, ".style.yapf")
+        with open(style, "w") as f:
+            f.write("[style]\nbased_on_style = pep8\nindent_width = 4\n")
+        assert library(input, tmpdir) == b"def f():\n    return 1\n"
+        with open(style, "w") as f:
+            f.write("[style]\nbased_on_style = pep8\nindent_width = 2\n")
+        assert library(input, tmpdir) == input
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_format_lines():
+    formatter, _ = S.get_formatter(S.CLANG_FORMAT_VERSION, S.YAPF_VERSION)
+    input = b"x=[ 1,2 ]\ny=[ 3,4 ]\n"
+    assert formatter(input, "a.py", "py", lines=[(2, 2)]) == b"x=[ 1,2 ]\ny = [3, 4]\n"
+    assert formatter(input, "a.py", "py") == b"x = [1, 2]\ny = [3, 4]\n"
+
+
+def test_format_lines_from_diff():
+    import sys
+    from subprocess import check_call
+
+    if not S.get_yapf_library():
+        return  # yapf module not available
+    tmpdir = tempfile.mkdtemp()
+    try:
+        git = ["git", "-c", "user.name=A", "-c", "user.email=a@b.c"]
+
+        def write(name, content):
+            with open(os.path.join(tmpdir, name), "wb") as f:
+                f.write(content)
+
+        def read(name):
+            with open(os.path.join(tmpdir, name), "rb") as f:
+                return f.read()
+
+        check_call(git + ["init", "-q", "."], cwd=tmpdir)
+        write("a.py", b"x=[ 1,2 ]\ny=[ 3,4 ]\n")
+        write("b.py", b"u=[ 1,2 ]\nv=[ 3,4 ]\n")
+        check_call(git + ["add", "."], cwd=tmpdir)
+        check_call(git + ["commit", "-q", "-m", "base"], cwd=tmpdir)
+        check_call(git + ["tag", "base"], cwd=tmpdir)
+        # committed change
+        write("a.py", b"x=[ 1,2 ]\ny=[ 5,6 ]\n")
+        check_call(git + ["commit", "-q", "-am", "change"], cwd=tmpdir)
+        # uncommitted change in a file without committed changes
+        write("b.py", b"u=[ 7,8 ]\nv=[ 3,4 ]\n")
+
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+            [os.path.dirname(os.path.dirname(S.__file__))]
+            + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else [])
+        )
+        check_call(
+            [
+                sys.executable,
+                "-c",
+                "from LbDevTools.SourceTools import format; format()",
+                "--no-cache",
+                "--reference=base",
+                "--lines-from-diff",
+            ],
+            cwd=tmpdir,
+            env=env,
+        )
+        assert read("a.py") == b"x=[ 1,2 ]\ny = [5, 6]\n"
+        assert read("b.py") == b"u = [7, 8]\nv=[ 3,4 ]\n"
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_clang_format_style_dirs():
+    from subprocess import check_call
+
+    tmpdir = os.path.realpath(tempfile.mkdtemp())
+    try:
+        repo = os.path.join(tmpdir, "repo")
+        nested = os.path.join(repo, "nested")
+        os.makedirs(os.path.join(nested, "src"))
+        check_call(["git", "init", "-q", repo])
+        with open(os.path.join(nested, ".clang-format"), "w") as f:
+            f.write("BasedOnStyle: Google\n")
+
+        # the nested style is found also if it is looked up first
+        path = os.path.join(nested, "src", "a.cpp")
+        assert S.ensure_clang_format_style(path) == nested
+        # the default style is created at the top of the repository
+        path = os.path.join(repo, "a.cpp")
+        assert S.ensure_clang_format_style(path) == repo
+        assert os.path.exists(os.path.join(repo, ".clang-format"))
+        assert S.ensure_clang_format_style(nested) == nested
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_git_patch():
+    from subprocess import check_call
+
+    tmpdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        os.chdir(tmpdir)
+        check_call(["git", "init", "-q", "."])
+        os.makedirs("sub")
+        with open(os.path.join("sub", "a.py"), "wb") as f:
+            f.write(b"x=1\n")
+        check_call(["git", "add", "."])
+
+        os.chdir("sub")
+        patch = S.GitPatch()
+        patch.add("a.py", b"x=1\n", b"x=1\n")
+        assert len(patch) == 0
+        patch.add("a.py", b"x=1\n", b"x = 1\n")
+        assert len(patch) == 1
+        with open(os.path.join(tmpdir, "fix.patch"), "wb") as f:
+            patch.write(f, "test patch")
+
+        os.chdir(tmpdir)
+        with open("fix.patch", "rb") as f:
+            content = f.read()
+        assert b"Subject: [PATCH] Fixed formatting\n" in content
+        assert b"\n+++ b/sub/a.py\n" in content
+        check_call(["git", "apply", "fix.patch"])
+        with open(os.path.join("sub", "a.py"), "rb") as f:
+            assert f.read() == b"x = 1\n"
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+
+# fake clang-format, converting the files to upper case, recording the
+# arguments and failing in batch mode if a file name contains "bad"
+FAKE_CLANG_FORMAT = """#!{python}
+import sys
+from xml.sax.saxutils import escape
+
+args = sys.argv[1:]
+with open({log!r}, "a") as log:
+    log.write(repr(args) + "\\n")
+files = []
+for i, arg in enumerate(args):
+    if arg == "--":
+        files.extend(args[i + 1 :])
+        break
+    elif not arg.startswith("-"):
+        files.append(arg)
+    elif not arg.split("=")[0] in (
+        "-style", "-fallback-style", "-assume-filename", "-output-replacements-xml"
+    ):
+        sys.exit("unknown argument " + arg)
+if "-output-replacements-xml" not in args:
+    sys.stdout.write(sys.stdin.read().upper())
+    sys.exit(0)
+for name in files:
+    if "bad" in name:
+        sys.exit("cannot format " + name)
+    with open(name) as f:
+        data = f.read()
+    sys.stdout.write(
+        "<?xml version='1.0'?>\\n<replacements xml:space='preserve'>\\n"
+        "<replacement offset='0' length='{{}}'>{{}}</replacement>\\n"
+        "</replacements>\\n".format(len(data), escape(data.upper()))
+    )
+"""
+
+
+def test_format_files_batch():
+    import sys
+
+    tmpdir = tempfile.mkdtemp()
+    path = os.environ["PATH"]
+    cwd = os.getcwd()
+    try:
+        # file names relative to the current directory, as in lb-format
+        os.chdir(tmpdir)
+        log = os.path.join(tmpdir, "calls.log")
+        cmd = os.path.join(tmpdir, "bin", "clang-format")
+        os.makedirs(os.path.dirname(cmd))
+        with open(cmd, "w") as f:
+            f.write(FAKE_CLANG_FORMAT.format(python=sys.executable, log=log))
+        os.chmod(cmd, 0o755)
+        os.environ["PATH"] = os.pathsep.join([os.path.dirname(cmd), path])
+        formatter = S.Formatter("clang-format", None)
+
+        def format_files(names):
+            items = []
+            for name in names:
+                with open(name, "wb") as f:
+                    f.write(b"int f();\n")
+                items.append((b"int f();\n", name, "c", None))
+            if os.path.exists(log):
+                os.remove(log)
+            results = formatter.format_files(items)
+            with open(log) as f:
+                return results, len(f.readlines())
+
+        # one process for all the files (even with odd names)
+        results, calls = format_files(["a.cpp", "-dash.cpp", "c.h"])
+        assert results == [b"INT F();\n"] * 3
+        assert calls == 1
+
+        # failure of the batch: one process per file
+        results, calls = format_files(["a.cpp", "bad.cpp", "c.h"])
+        assert results == [b"INT F();\n"] * 3
+        assert calls == 4
+    finally:
+        os.chdir(cwd)
+        os.environ["PATH"] = path
+        shutil.rmtree(tmpdir)
+
+
+def test_format_jobs():
+    import re
+    import sys
+    from subprocess import check_call, Popen, PIPE
+
+    if not S.get_yapf_library():
+        return  # yapf module not available
+    tmpdir = tempfile.mkdtemp()
+    try:
+        git = ["git", "-c", "user.name=A", "-c", "user.email=a@b.c"]
+        check_call(git + ["init", "-q", "."], cwd=tmpdir)
+        check_call(git + ["commit", "-q", "--allow-empty", "-m", "base"], cwd=tmpdir)
+        for i in range(12):
+            with open(os.path.join(tmpdir, "f{:02}.py".format(i)), "wb") as f:
+                if i % 4 == 1:
+                    f.write(b"x = '\xe0'\n")  # not UTF-8
+                elif i % 2:
+                    f.write(b"x = [1, 2]\n")
+                else:
+                    f.write(b"x=[ 1,2 ]\n")
+        check_call(git + ["add", "."], cwd=tmpdir)
+        check_call(git + ["commit", "-q", "-m", "files"], cwd=tmpdir)
+
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+            [os.path.dirname(os.path.dirname(S.__file__))]
+            + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else [])
+        )
+
+        def run(*args):
+            proc = Popen(
+                [
+                    sys.executable,
+                    "-c",
+                    "from LbDevTools.SourceTools import format; format()",
+                    "--no-cache",
+                    "--batch-size=2",
+                ]
+                + list(args),
+                cwd=tmpdir,
+                env=env,
+                stdout=PIPE,
+                stderr=PIPE,
+            )
+            out, err = proc.communicate()
+            return out.decode(), re.findall(
+                r"invalid encoding in '(.*?)'", err.decode()
+            )
+
+        serial = run("-j", "1", "-n")
+        assert serial == run("-j", "4", "-n")
+        assert serial[0].splitlines()[:3] == [
+            "f00.py should be changed",
+            "f02.py should be changed",
+            "f04.py should be changed",
+        ]
+        assert serial[1] == ["f01.py", "f05.py", "f09.py"]
+        assert " - f01.py\n - f05.py\n - f09.py\n" in serial[0]
+
+        patches = []
+        for jobs in ("1", "4"):
+            patch = os.path.join(tmpdir, "fix{}.patch".format(jobs))
+            output, errors = run("-j", jobs, "--format-patch", patch, "HEAD^")
+            assert errors == serial[1]
+            with open(patch) as f:
+                patches.append(
+                    [l for l in f.read().splitlines() if not l.startswith("Date:")]
+                )
+        assert patches[0] == patches[1]
+        assert [l for l in patches[0] if l.startswith("+++")] == [
+            "+++ b/f{:02}.py".format(i) for i in range(0, 12, 2)
+        ]
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_discover_command():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cache_path = os.path.join(tmpdir, "cache", "tools.json")
+        cmd = os.path.join(tmpdir, "tool")
+        with open(cmd, "w") as f:
+            f.write("#!/bin/sh\n")
+        calls = []
+
+        def find():
+            calls.append(1)
+            return cmd
+
+        for _ in range(2):
+            assert S.discover_command("tool", "1", find, cache_path) == cmd
+        assert len(calls) == 1
+        # different version
+        assert S.discover_command("tool", "2", find, cache_path) == cmd
+        assert len(calls) == 2
+        # the command changed
+        with open(cmd, "a") as f:
+            f.write("exit 0\n")
+        assert S.discover_command("tool", "1", find, cache_path) == cmd
+        assert len(calls) == 3
+        # not found results are not cached
+        assert S.discover_command("other", "1", lambda: None, cache_path) is None
+        assert S.discover_command("other", "1", find, cache_path) == cmd
+        assert len(calls) == 4
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,366 @@
+###############################################################################
+# (c) Copyright 2021 CERN for the benefit of the LHCb Collaboration           #
+#                                                                             #
+# This software is distributed under the terms of the GNU General Public      #
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".   #
+#                                                                             #
+# In applying this licence, CERN does not waive the privileges and immunities #
+# granted to it by virtue of its status as an Intergovernmental Organization  #
+# or submit itself to any jurisdiction.                                       #
+###############################################################################
+from __future__ import print_function
+
+from __future__ import absolute_import
+import os
+import shutil
+import sys
+import tempfile
+from subprocess import CalledProcessError, check_call, check_output
+
+from LbDevTools.GitTools import checkout
+
+ROOT_DIR = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+)
+PACKAGES = ["Det/DetDesc", "Kernel/LHCbKernel", "Old", "Tools/Old/Pkg"]
+
+
+def git(repo, *args):
+    check_call(
+        ["git", "-c", "user.name=A", "-c", "user.email=a@b.c"] + list(args), cwd=repo
+    )
+
+
+def run_command(module, repo, *args):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [ROOT_DIR] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else [])
+    )
+    return check_output(
+        [
+            sys.executable,
+            "-c",
+            "from LbDevTools.GitTools.{} import main; main()".format(module),
+        ]
+        + list(args),
+        cwd=repo,
+        env=env,
+    ).decode()
+
+
+def run_checkout(repo, *args):
+    return run_command("checkout", repo, *args)
+
+
+def run_use(repo, *args):
+    return run_command("use", repo, *args)
+
+
+def make_project(path):
+    """
+    Create a git repository with a few packages (CMake and CMT ones).
+    """
+    os.makedirs(path)
+    check_call(["git", "init", "-q", path])
+    files = [
+        "CMakeLists.txt",
+        "README.md",
+        "Det/DetDesc/CMakeLists.txt",
+        "Det/DetDesc/src/Code.cpp",
+        "Kernel/LHCbKernel/CMakeLists.txt",
+        "Kernel/LHCbKernel/cmt/requirements",
+        "Old/cmt/requirements",
+        "Tools/Old/Pkg/cmt/requirements",
+        "Tools/NotAPackage/file.txt",
+    ]
+    for name in files:
+        name = os.path.join(path, name)
+        if not os.path.isdir(os.path.dirname(name)):
+            os.makedirs(os.path.dirname(name))
+        with open(name, "w") as f:
+            f.write(name + "\n")
+    git(path, "add", ".")
+    git(path, "commit", "-q", "-m", "initial")
+    return path
+
+
+def test_get_packages_of():
+    import git as gitpython
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = make_project(os.path.join(tmpdir, "Project"))
+        repo = gitpython.Repo(path)
+        assert sorted(checkout.get_packages_of(repo, "HEAD")) == PACKAGES
+
+        # the result is recorded per tree
+        tree = repo.commit("HEAD").tree.hexsha
+        index = os.path.join(repo.git_dir, "lb-checkout-packages", tree)
+        with open(index) as f:
+            assert f.read().splitlines() == PACKAGES
+        with open(index, "a") as f:
+            f.write("Recorded/Pkg\n")
+        assert "Recorded/Pkg" in checkout.get_packages_of(repo, "HEAD")
+
+        assert run_checkout(path, "--list", "HEAD").splitlines() == sorted(
+            PACKAGES + ["Recorded/Pkg"]
+        )
+
+        # only the most recently used lists are kept
+        index_dir = os.path.dirname(index)
+        for i in range(5):
+            with open(os.path.join(index_dir, "old{}".format(i)), "w") as f:
+                f.write("")
+            os.utime(os.path.join(index_dir, "old{}".format(i)), (i, i))
+        checkout.prune_packages_index(index_dir, 3)
+        assert sorted(os.listdir(index_dir)) == sorted(["old3", "old4", tree])
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def make_satellite(path, *projects):
+    """
+    Create a git repository using the 'projects' as remotes, as `git lb-use`
+    does.
+    """
+    os.makedirs(path)
+    check_call(["git", "init", "-q", path])
+    with open(os.path.join(path, "CMakeLists.txt"), "w") as f:
+        f.write(
+            "# begin: list of subdirectories\n"
+            "    Some/Pkg\n"
+            "# end: list of subdirectories\n"
+        )
+    git(path, "add", "CMakeLists.txt")
+    git(path, "commit", "-q", "-m", "initial")
+    for project in projects:
+        name = os.path.basename(project)
+        git(path, "remote", "add", name, project)
+        git(path, "config", "remote.{}.tagopt".format(name), "--no-tags")
+        git(
+            path,
+            "config",
+            "--add",
+            "remote.{}.fetch".format(name),
+            "+refs/tags/*:refs/tags/{}/*".format(name),
+        )
+        git(path, "fetch", "-q", name)
+    return path
+
+
+def test_find_remote():
+    import git as gitpython
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        project = make_project(os.path.join(tmpdir, "LHCb"))
+        git(project, "tag", "-a", "-m", "v1", "v1")
+        for i in range(3):
+            git(project, "commit", "-q", "--allow-empty", "-m", "change {}".format(i))
+        path = make_satellite(os.path.join(tmpdir, "Satellite"), project)
+        git(path, "tag", "local")
+        repo = gitpython.Repo(path)
+
+        branch = repo.git.rev_parse("LHCb/master")
+        assert checkout.find_remote(repo, branch) == "LHCb"
+        assert checkout.find_remote(repo, branch[:8] + "~1") == "LHCb"
+        assert checkout.find_remote(repo, repo.git.rev_parse("LHCb/v1")) == "LHCb"
+        assert checkout.find_remote(repo, "LHCb/v1~0") == "LHCb"
+        assert checkout.find_remote(repo, "HEAD") is None
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_checkout_from_file():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        lhcb = make_project(os.path.join(tmpdir, "LHCb"))
+        other = make_project(os.path.join(tmpdir, "Other"))
+        path = make_satellite(os.path.join(tmpdir, "Satellite"), lhcb, other)
+        other_head = (
+            check_output(["git", "rev-parse", "HEAD"], cwd=other).decode().strip()
+        )
+        manifest = os.path.join(tmpdir, "pkgs.txt")
+        with open(manifest, "w") as f:
+            f.write(
+                "# packages to check out\n"
+                "LHCb/master Det/DetDesc\n"
+                "\n"
+                "{} Old\n"
+                "LHCb/master Kernel/\n".format(other_head)
+            )
+
+        run_checkout(path, "--from-file", manifest)
+
+        log = check_output(["git", "log", "-z", "--format=%B"], cwd=path).decode()
+        log = log.rstrip("\0").split("\0")
+        assert len(log) == 2
+        assert log[0].splitlines() == [
+            "added packages:",
+            " - Det/DetDesc from LHCb (LHCb/master)",
+            " - Kernel/LHCbKernel from LHCb (LHCb/master)",
+            " - Old from Other ({})".format(other_head),
+        ]
+        files = check_output(["git", "ls-files"], cwd=path).decode().splitlines()
+        assert "Det/DetDesc/src/Code.cpp" in files
+        assert "Kernel/LHCbKernel/cmt/requirements" in files
+        assert "Old/cmt/requirements" in files
+        assert "Tools/Old/Pkg/cmt/requirements" not in files
+        with open(os.path.join(path, "CMakeLists.txt")) as f:
+            assert [l.strip() for l in f][1:-1] == [
+                "Det/DetDesc",
+                "Kernel/LHCbKernel",
+                "Old",
+                "Some/Pkg",
+            ]
+        sections = check_output(
+            ["git", "config", "-f", ".git-lb-checkout", "--name-only", "--list"],
+            cwd=path,
+        ).decode()
+        assert sorted(set(l.rsplit(".", 1)[0] for l in sections.splitlines())) == [
+            "lb-checkout.LHCb.Det/DetDesc",
+            "lb-checkout.LHCb.Kernel/LHCbKernel",
+            "lb-checkout.Other.Old",
+        ]
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_partial_use():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        project = make_project(os.path.join(tmpdir, "LHCb"))
+        git(project, "tag", "v1")
+        git(project, "tag", "old")
+        git(project, "commit", "-q", "--allow-empty", "-m", "second")
+        git(project, "config", "uploadpack.allowFilter", "true")
+        path = make_satellite(os.path.join(tmpdir, "Satellite"))
+        url = "file://" + project
+
+        run_use(
+            path,
+            "LHCb",
+            url,
+            "--filter=blob:none",
+            "--depth=1",
+            "--tags-matching=v*",
+        )
+        refs = check_output(["git", "for-each-ref", "--format=%(refname)"], cwd=path)
+        assert sorted(refs.decode().splitlines()) == [
+            "refs/heads/master",
+            "refs/remotes/LHCb/master",
+            "refs/tags/LHCb/v1",
+        ]
+
+        def missing():
+            return [
+                l[1:]
+                for l in check_output(
+                    ["git", "rev-list", "--objects", "--missing=print", "LHCb/master"],
+                    cwd=path,
+                )
+                .decode()
+                .splitlines()
+                if l.startswith("?")
+            ]
+
+        # only one commit and no files
+        assert (
+            check_output(["git", "rev-list", "--count", "LHCb/master"], cwd=path)
+            .decode()
+            .strip()
+            == "1"
+        )
+        blobs = check_output(["git", "ls-tree", "-r", "LHCb/master"], cwd=path)
+        blobs = dict(reversed(l.split()[2:]) for l in blobs.decode().splitlines())
+        assert sorted(missing()) == sorted(blobs.values())
+
+        # only the files of the package are fetched
+        run_checkout(path, "LHCb/master", "Det/DetDesc")
+        assert sorted(missing()) == sorted(
+            oid for name, oid in blobs.items() if not name.startswith("Det/DetDesc/")
+        )
+        with open(os.path.join(path, "Det", "DetDesc", "src", "Code.cpp")) as f:
+            assert f.read().endswith("Code.cpp\n")
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_use_many_projects():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for name in ("LHCb", "Other"):
+            make_project(os.path.join(tmpdir, name + ".git"))
+            git(os.path.join(tmpdir, name + ".git"), "tag", "v1")
+        path = make_satellite(os.path.join(tmpdir, "Satellite"))
+        # redirect the standard urls to the local repositories
+        git(
+            path,
+            "config",
+            "url.file://{}/.insteadOf".format(tmpdir),
+            "https://gitlab.cern.ch/lhcb/",
+        )
+        os.makedirs(os.path.join(path, "cmake"))
+        with open(os.path.join(path, "cmake", "SatelliteDependencies.cmake"), "w") as f:
+            f.write(
+                "# Dependencies\n"
+                "lhcb_find_package(Other REQUIRED)\n"
+                "lhcb_find_package(LHCb v1r0 EXACT REQUIRED)\n"
+            )
+
+        run_use(path, "--protocol=https", "-j2")
+
+        remotes = check_output(
+            ["git", "config", "--get-regexp", r"^remote\."], cwd=path
+        ).decode()
+        assert remotes.splitlines() == [
+            "remote.Other.url https://gitlab.cern.ch/lhcb/Other.git",
+            "remote.Other.fetch +refs/heads/*:refs/remotes/Other/*",
+            "remote.Other.tagopt --no-tags",
+            "remote.Other.fetch +refs/tags/*:refs/tags/Other/*",
+            "remote.LHCb.url https://gitlab.cern.ch/lhcb/LHCb.git",
+            "remote.LHCb.fetch +refs/heads/*:refs/remotes/LHCb/*",
+            "remote.LHCb.tagopt --no-tags",
+            "remote.LHCb.fetch +refs/tags/*:refs/tags/LHCb/*",
+        ]
+        refs = check_output(["git", "for-each-ref", "--format=%(refname)"], cwd=path)
+        assert sorted(refs.decode().splitlines()) == [
+            "refs/heads/master",
+            "refs/remotes/LHCb/master",
+            "refs/remotes/Other/master",
+            "refs/tags/LHCb/v1",
+            "refs/tags/Other/v1",
+        ]
+
+        # failures are reported
+        try:
+            run_use(path, "--protocol=https", "LHCb", "Missing")
+            assert False, "git lb-use should fail"
+        except CalledProcessError:
+            pass
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_fetch_remote_retry():
+    from threading import Timer
+    from LbDevTools.GitTools import use
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        make_project(os.path.join(tmpdir, "LHCb"))
+        path = make_satellite(os.path.join(tmpdir, "Satellite"))
+        git(path, "remote", "add", "LHCb", os.path.join(tmpdir, "LHCb"))
+        # a concurrent fetch holds the lock of the ref for a while
+        lock = os.path.join(path, ".git", "refs", "remotes", "LHCb", "master.lock")
+        os.makedirs(os.path.dirname(lock))
+        open(lock, "w").close()
+        timer = Timer(0.3, os.remove, [lock])
+        timer.start()
+        try:
+            branches, _ = use.fetch_remote(path, "LHCb")
+        finally:
+            timer.join()
+        assert branches == ["LHCb/master"]
+    finally:
+        shutil.rmtree(tmpdir)
@@ -90,3 +90,432 @@ class TestScript(object):
             assert (
                 "~Decoding ~Muon | Improve MuonRawToHits, " "LHCb!2177 (@rvazquez)"
             ) in output
+
+
+def make_mr_history(path, n=3):
+    """
+    Create in 'path' a repository (and its 'origin') with 'n' merge
+    requests merged after the tag v1, returning the path to the clone.
+
+    One merge request in three is squashed (2, 5, ...) and one in three is
+    merged with a custom message (3, 6, ...).
+    """
+    # the name of the remote is used to guess the GitLab project
+    origin = os.path.join(path, "gitlab.cern.ch", "lhcb", "Foo.git")
+    repo = os.path.join(path, "repo")
+
+    def git(*args):
+        check_call(
+            ["git", "-c", "user.name=A", "-c", "user.email=a@b.c"] + list(args),
+            cwd=repo,
+        )
+
+    os.makedirs(os.path.dirname(origin))
+    check_call(["git", "init", "-q", "--bare", origin])
+    check_call(["git", "init", "-q", repo])
+    git("remote", "add", "origin", origin)
+    git("commit", "-q", "--allow-empty", "-m", "initial")
+    git("tag", "v1")
+    git("branch", "-M", "master")
+    for iid in range(1, n + 1):
+        git("checkout", "-q", "-b", "mr{}".format(iid), "master")
+        git("commit", "-q", "--allow-empty", "-m", "change {}".format(iid))
+        git("push", "-q", "origin", "HEAD:refs/merge-requests/{}/head".format(iid))
+        if iid % 3 == 2:  # squashed
+            git("commit", "-q", "--amend", "--allow-empty", "-m", "squashed")
+        git("checkout", "-q", "master")
+        message = "Merge branch 'mr{0}' into 'master'".format(iid)
+        if iid % 3:  # the others are merged with a custom message
+            message += "\n\nSee merge request lhcb/Foo!{}".format(iid)
+        git("merge", "-q", "--no-ff", "-m", message, "mr{}".format(iid))
+    return repo
+
+
+def test_narrow_fetch():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        repo = make_mr_history(tmpdir)
+        origin = os.path.join(tmpdir, "gitlab.cern.ch", "lhcb", "Foo.git")
+        moved = origin + ".moved"
+
+        def git(*args):
+            check_call(
+                ["git", "-c", "user.name=A", "-c", "user.email=a@b.c"] + list(args),
+                cwd=repo,
+            )
+
+        def local_mrs():
+            return sorted(
+                int(name.rsplit("/", 1)[1])
+                for names in ReleaseNotes.merge_request_refs(repo).values()
+                for name in names
+            )
+
+        # an open merge request
+        git("push", "-q", "origin", "mr1:refs/merge-requests/4/head")
+
+        # MRs 1 and 2 have the trailer: only their refs are fetched
+        iids = ReleaseNotes.find_merge_request_iids(repo, "v1", "HEAD^", "narrow")
+        assert iids == [2, 1]
+        assert local_mrs() == [1, 2]
+        # nothing to fetch the second time (origin not accessible)
+        os.rename(origin, moved)
+        iids = ReleaseNotes.find_merge_request_iids(repo, "v1", "HEAD^", "narrow")
+        assert iids == [2, 1]
+        os.rename(moved, origin)
+
+        # MR 3 has no trailer, so we need all refs
+        iids = ReleaseNotes.find_merge_request_iids(repo, "v1", fetch="narrow")
+        assert iids == [3, 2, 1]
+        assert local_mrs() == [1, 2, 3, 4]
+
+        # a merge without merge request is recorded after the first attempt
+        git("checkout", "-q", "-b", "direct", "master")
+        git("commit", "-q", "--allow-empty", "-m", "direct change")
+        git("checkout", "-q", "master")
+        git("merge", "-q", "--no-ff", "-m", "Merge branch 'direct'", "direct")
+        iids = ReleaseNotes.find_merge_request_iids(repo, "v1", fetch="narrow")
+        assert iids == [3, 2, 1]
+        os.rename(origin, moved)
+        iids = ReleaseNotes.find_merge_request_iids(repo, "v1", fetch="narrow")
+        assert iids == [3, 2, 1]
+        os.rename(moved, origin)
+
+        # trailers of merge requests of other projects are not fetched
+        git("checkout", "-q", "-b", "upstream", "master")
+        git("commit", "-q", "--allow-empty", "-m", "upstream change")
+        git("checkout", "-q", "master")
+        message = "Merge branch 'upstream'\n\nSee merge request lhcb/Bar!7"
+        git("merge", "-q", "--no-ff", "-m", message, "upstream")
+        os.rename(origin, moved)
+        ReleaseNotes.find_merge_request_iids(repo, "v1", fetch="narrow")
+        assert local_mrs() == [1, 2, 3, 4]
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+class FakeMergeRequests(object):
+    def list(self, **kwargs):
+        return list(kwargs["iids[]"])
+
+
+class FakeProject(object):
+    mergerequests = FakeMergeRequests()
+
+
+def test_find_merge_requests_git():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        repo = make_mr_history(tmpdir)
+        mrs = ReleaseNotes.find_merge_requests_git(FakeProject(), repo, "v1")
+        assert mrs == [3, 2, 1]
+        # same result without the bulk queries
+        merges = ReleaseNotes.git_o(
+            ["log", "--first-parent", "--merges", "--format=%H %P", "v1.."], cwd=repo
+        )
+        assert [
+            ReleaseNotes.find_merge_request_id(repo, ids[0], ids[2])
+            for ids in (l.split() for l in merges.splitlines())
+        ] == mrs
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+class FakeGitLab(object):
+    """
+    Minimal GitLab API server for project lhcb/Foo, with merge requests 1 to
+    'n' (the odd ones with milestone v2).
+
+    The first query of merge requests by iids fails with a transient error.
+    """
+
+    def __init__(self, n=3):
+        from threading import Thread
+        from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        from six.moves.socketserver import ThreadingMixIn
+
+        self.n = n
+        self.requests = []
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake.requests.append(self.path)
+                status, data = fake.reply(self.path)
+                body = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}/".format(self.server.server_address[1])
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @staticmethod
+    def merge_request(iid):
+        return {
+            "id": 100 + iid,
+            "iid": iid,
+            "project_id": 1,
+            "title": "Change {}".format(iid),
+            "description": "",
+            "labels": [],
+            "state": "merged",
+            "reference": "!{}".format(iid),
+            "web_url": "https://gitlab.cern.ch/lhcb/Foo/merge_requests/{}".format(iid),
+            "updated_at": "2021-01-0{}T00:00:00.000Z".format(iid),
+            "author": {"username": "user{}".format(iid)},
+        }
+
+    def reply(self, path):
+        from six.moves.urllib.parse import urlparse, parse_qs
+
+        url = urlparse(path)
+        query = parse_qs(url.query)
+        if url.path == "/api/v4/projects/lhcb%2FFoo":
+            return 200, {"id": 1, "name": "Foo", "path_with_namespace": "lhcb/Foo"}
+        elif url.path == "/api/v4/projects/1/merge_requests":
+            if sum(p.startswith(url.path) for p in self.requests) == 1:
+                return 503, {"message": "try again"}
+            return 200, [self.merge_request(int(i)) for i in query["iids[]"]]
+        elif url.path == "/api/v4/projects/1/milestones":
+            return 200, [{"id": 5, "iid": 1, "project_id": 1, "title": "v2"}]
+        elif url.path == "/api/v4/projects/1/milestones/5/merge_requests":
+            return 200, [self.merge_request(i) for i in range(self.n, 0, -1) if i % 2]
+        return 404, {"message": "404 Not Found"}
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def test_find_merge_requests_fake_gitlab():
+    tmpdir = tempfile.mkdtemp()
+    gitlab = FakeGitLab()
+    fetcher = ReleaseNotes.GitLabFetcher(jobs=4, backoff=0)
+    try:
+        repo = make_mr_history(tmpdir)
+        server = ReleaseNotes.get_gitlab_server(gitlab.url, jobs=4)
+        mrs = ReleaseNotes.find_merge_requests(server, repo, "v1", "v2", fetcher)
+        assert [mr.iid for mr in mrs] == [3, 2, 1]
+        assert mrs[0].fullname == "lhcb/Foo"
+        # one failure and one retry
+        queries = [p for p in gitlab.requests if p.startswith("/api/v4/projects/1/m")]
+        assert sorted(p.split("?")[0] for p in queries) == [
+            "/api/v4/projects/1/merge_requests",
+            "/api/v4/projects/1/merge_requests",
+            "/api/v4/projects/1/milestones",
+            "/api/v4/projects/1/milestones/5/merge_requests",
+        ]
+        assert any("per_page=100" in p for p in gitlab.requests)
+    finally:
+        fetcher.close()
+        gitlab.close()
+        shutil.rmtree(tmpdir)
+
+
+def test_find_merge_requests_ambiguous_milestone():
+    class AmbiguousGitLab(FakeGitLab):
+        def reply(self, path):
+            if path.startswith("/api/v4/projects/1/milestones?"):
+                return 200, [
+                    {"id": i, "iid": i, "project_id": 1, "title": "v2"} for i in (5, 6)
+                ]
+            return FakeGitLab.reply(self, path)
+
+    tmpdir = tempfile.mkdtemp()
+    gitlab = AmbiguousGitLab()
+    fetcher = ReleaseNotes.GitLabFetcher(jobs=4, backoff=0)
+    try:
+        repo = make_mr_history(tmpdir)
+        server = ReleaseNotes.get_gitlab_server(gitlab.url, jobs=4)
+        try:
+            ReleaseNotes.find_merge_requests(server, repo, "v1", "v2", fetcher)
+            assert False, "exception expected"
+        except ValueError as err:
+            assert "Multiple milestones" in str(err)
+    finally:
+        fetcher.close()
+        gitlab.close()
+        shutil.rmtree(tmpdir)
+
+
+def test_offline_release_notes():
+    tmpdir = tempfile.mkdtemp()
+    gitlab = FakeGitLab()
+    try:
+        repo = make_mr_history(tmpdir)
+        cache_file = os.path.join(tmpdir, "cache.json")
+        args = ["-C", repo, "--cache-file", cache_file, "v1", "v2"]
+        output1 = os.path.join(tmpdir, "online.md")
+        ReleaseNotes.main(args + ["--gitlab-url", gitlab.url, "-o", output1])
+        n_requests = len(gitlab.requests)
+        assert n_requests
+
+        output2 = os.path.join(tmpdir, "offline.md")
+        ReleaseNotes.main(args + ["--offline", "-o", output2])
+        assert len(gitlab.requests) == n_requests
+
+        with open(output1) as f1, open(output2) as f2:
+            content = f1.read()
+            assert f2.read() == content
+        assert "Change 2, !2 (@user2)" in content
+    finally:
+        gitlab.close()
+        shutil.rmtree(tmpdir)
+
+
+def test_stack_scheduler():
+    tmpdir = tempfile.mkdtemp()
+    gitlab = FakeGitLab()
+    fetcher = ReleaseNotes.GitLabFetcher(jobs=4, backoff=0)
+    try:
+        repos = [make_mr_history(os.path.join(tmpdir, name)) for name in "AB"]
+        server = ReleaseNotes.get_gitlab_server(gitlab.url, jobs=4)
+        scheduler = ReleaseNotes.StackScheduler(
+            [(repo, "v1", "v2") for repo in repos], server, fetcher=fetcher, jobs=2
+        )
+        try:
+            mrs = scheduler.get()
+        finally:
+            scheduler.close()
+        assert [mr.iid for mr in mrs] == [3, 2, 1, 3, 2, 1]
+
+        # failures are reported to the caller
+        scheduler = ReleaseNotes.StackScheduler(
+            [(tmpdir, "v1", "v2")], server, fetcher=fetcher
+        )
+        try:
+            scheduler.get()
+            assert False, "exception expected"
+        except AssertionError:
+            raise
+        except Exception:
+            pass
+        finally:
+            scheduler.close()
+    finally:
+        fetcher.close()
+        gitlab.close()
+        shutil.rmtree(tmpdir)
+
+
+class CountGitCalls(object):
+    """
+    Context manager recording the git commands started (via subprocess.Popen)
+    in the block.
+    """
+
+    def __enter__(self):
+        import subprocess
+
+        self.calls = calls = []
+        self._popen = Popen = subprocess.Popen
+
+        class CountingPopen(Popen):
+            def __init__(self, *args, **kwargs):
+                cmd = args[0] if args else kwargs["args"]
+                if cmd[0] == "git":
+                    calls.append(cmd)
+                super(CountingPopen, self).__init__(*args, **kwargs)
+
+        subprocess.Popen = CountingPopen
+        return self
+
+    def __exit__(self, *args):
+        import subprocess
+
+        subprocess.Popen = self._popen
+
+
+class TestBenchmark(object):
+    """
+    Measure the cost of the release notes generation on a synthetic history
+    with many merge requests, served by a local FakeGitLab.
+
+    The number of git commands and of HTTP requests must not depend on the
+    number of merge requests (except for the pagination of the queries).
+    """
+
+    N = 150
+
+    @classmethod
+    def setup_class(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.repo = make_mr_history(cls.tmpdir, cls.N)
+        cls.gitlab = FakeGitLab(cls.N)
+
+    @classmethod
+    def teardown_class(cls):
+        cls.gitlab.close()
+        shutil.rmtree(cls.tmpdir)
+
+    def measure(self, function, *args, **kwargs):
+        import time
+
+        del self.gitlab.requests[:]
+        start = time.time()
+        with CountGitCalls() as git_calls:
+            result = function(*args, **kwargs)
+        elapsed = time.time() - start
+        print(
+            "{}: {:.3f}s, {} git commands, {} HTTP requests".format(
+                function.__name__,
+                elapsed,
+                len(git_calls.calls),
+                len(self.gitlab.requests),
+            )
+        )
+        return result, git_calls.calls, list(self.gitlab.requests)
+
+    def test_find_merge_requests(self):
+        server = ReleaseNotes.get_gitlab_server(self.gitlab.url, jobs=4)
+        fetcher = ReleaseNotes.GitLabFetcher(jobs=4, backoff=0)
+        try:
+            mrs, git_calls, requests = self.measure(
+                ReleaseNotes.find_merge_requests, server, self.repo, "v1", "v2", fetcher
+            )
+        finally:
+            fetcher.close()
+        assert [mr.iid for mr in mrs] == list(range(self.N, 0, -1))
+        # remote, log, fetch and for-each-ref
+        assert [cmd[1] for cmd in git_calls] == [
+            "remote",
+            "log",
+            "fetch",
+            "for-each-ref",
+        ]
+        # project, 2 pages of merge requests (+ 1 retry), milestones and
+        # merge requests of the milestone
+        assert len(requests) == 6
+
+    def test_main(self):
+        output = os.path.join(self.tmpdir, "notes.md")
+        args = [
+            "-C",
+            self.repo,
+            "--gitlab-url",
+            self.gitlab.url,
+            "--cache-file",
+            os.path.join(self.tmpdir, "cache.json"),
+            "-o",
+            output,
+            "v1",
+            "v2",
+        ]
+        _, git_calls, requests = self.measure(ReleaseNotes.main, args)
+        with open(output) as f:
+            content = f.read()
+        assert all("!{} ".format(i) in content for i in range(1, self.N + 1))
+        assert len(git_calls) == 5
+        assert len(requests) == 6
@@ -0,0 +1,75 @@
+###############################################################################
+# (c) Copyright 2021 CERN for the benefit of the LHCb Collaboration           #
+#                                                                             #
+# This software is distributed under the terms of the GNU General Public      #
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".   #
+#                                                                             #
+# In applying this licence, CERN does not waive the privileges and immunities #
+# granted to it by virtue of its status as an Intergovernmental Organization  #
+# or submit itself to any jurisdiction.                                       #
+###############################################################################
+from __future__ import print_function
+
+from __future__ import absolute_import
+import json
+import os
+import re
+import sys
+from subprocess import check_output
+
+ROOT_DIR = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+)
+SETUP_PY = os.path.join(ROOT_DIR, "setup.py")
+
+# modules that are slow to import and should only be loaded when needed
+HEAVY_MODULES = ["pkg_resources", "gitlab", "jinja2", "git"]
+
+# time the import of an entry point in a clean interpreter and report the
+# heavy modules loaded
+PROBE = """
+import json, sys, time
+start = time.time()
+module = __import__({module!r}, fromlist=["_"])
+getattr(module, {function!r})
+print(json.dumps({{
+    "time": time.time() - start,
+    "heavy": [m for m in {heavy!r} if m in sys.modules],
+}}))
+"""
+
+
+def get_entry_points():
+    """
+    Return the list of (name, module, function) of the console scripts
+    declared in setup.py.
+    """
+    with open(SETUP_PY) as f:
+        content = f.read()
+    return re.findall(r'"([\w-]+)=([\w.]+):(\w+)"', content)
+
+
+def test_entry_points_startup():
+    if sys.version_info < (3, 7):
+        # the version of the package can be looked up lazily only with the
+        # module __getattr__ of Python 3.7
+        return
+    entry_points = get_entry_points()
+    assert entry_points
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [ROOT_DIR] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else [])
+    )
+    results = {}
+    for name, module, function in entry_points:
+        probe = PROBE.format(module=module, function=function, heavy=HEAVY_MODULES)
+        results[name] = json.loads(
+            check_output([sys.executable, "-c", probe], env=env).decode()
+        )
+
+    # record the import times, to spot regressions
+    for name in sorted(results):
+        print("{:<25} {:8.3f}s".format(name, results[name]["time"]))
+
+    assert {name: r["heavy"] for name, r in results.items() if r["heavy"]} == {}